@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+    Benchmarks ingestion, the stats queries and chart rendering against a throwaway Postgres.
+
+    Run from the repository root, with initdb and pg_ctl on PATH (or --pg-bin), or --dsn pointing at a server
+    where a scratch database can be created. Results are written as JSON, along with the commit they were taken at,
+    so runs can be compared with benchmarks/compare.py.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import uuid
+from contextlib import asynccontextmanager
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg
+import numpy as np
+from PIL import Image
+
+from cogs import pop, stats
+from cogs.utils import charts, images
+from cogs.utils.membership import MembershipIndex
+from cogs.utils.timeline import HourGrid, Timeline, arrays, charted
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema.sql')
+
+
+def summarize(samples):
+    ms = sorted(s * 1000 for s in samples)
+    return {
+        'n' : len(ms),
+        'mean_ms' : statistics.fmean(ms),
+        'p50_ms' : ms[len(ms) // 2],
+        'p95_ms' : ms[min(len(ms) - 1, int(len(ms) * 0.95))],
+        'max_ms' : ms[-1],
+    }
+
+async def timed(samples, coro):
+    start = time.perf_counter()
+    result = await coro
+    samples.append(time.perf_counter() - start)
+    return result
+
+def timed_call(samples, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+@asynccontextmanager
+async def local_postgres(pg_bin):
+    """Runs a postgres cluster in a temporary directory, listening only on a unix socket in it."""
+    def tool(name):
+        return os.path.join(pg_bin, name) if pg_bin else name
+    with tempfile.TemporaryDirectory(prefix='koishi-bench-') as tmp:
+        data = os.path.join(tmp, 'data')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        subprocess.run([tool('initdb'), '-D', data, '-A', 'trust', '-U', 'koishi'], check=True, stdout=subprocess.DEVNULL)
+        options = f"-k {tmp} -p {port} -c listen_addresses='' -c fsync=off -c synchronous_commit=off"
+        subprocess.run([tool('pg_ctl'), '-D', data, '-o', options, '-w', '-l', os.path.join(tmp, 'log'), 'start'], check=True, stdout=subprocess.DEVNULL)
+        try:
+            yield f'postgresql://koishi@/postgres?host={tmp}&port={port}'
+        finally:
+            subprocess.run([tool('pg_ctl'), '-D', data, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+
+async def init(con):
+    # the same jsonb codec as bot.create_pool, insert_member_removes relies on it
+    await con.set_type_codec('jsonb', schema='pg_catalog', encoder=lambda data: json.dumps(data, default=str), decoder=json.loads, format='text')
+
+@asynccontextmanager
+async def scratch_database(dsn):
+    """Creates a database with schema.sql loaded into koi_test, dropped afterwards."""
+    name = f'koishi_bench_{uuid.uuid4().hex[:8]}'
+    admin = await asyncpg.connect(dsn)
+    await admin.execute(f'create database {name}')
+    try:
+        pool = await asyncpg.create_pool(dsn, database=name, server_settings={'search_path' : 'koi_test,public'}, init=init)
+        try:
+            async with pool.acquire() as con:
+                await con.execute('create schema koi_test')
+                with open(SCHEMA) as f:
+                    await con.execute(f.read())
+            yield pool
+        finally:
+            await pool.close()
+    finally:
+        await admin.execute(f'drop database {name}')
+        await admin.close()
+
+
+def generate(args, now):
+    """
+        Synthetic presence histories over args.days up to now: status changes arriving as a Poisson process per user,
+        users spread over guilds with args.overlap guilds each on average, and some of them leaving all of theirs.
+        Returns the statuses and member_removes records in time order, and the membership of every user.
+    """
+    rng = np.random.default_rng(args.seed)
+    start = now - datetime.timedelta(days=args.days)
+    uids = np.arange(1, args.users + 1, dtype=np.int64) * 1000003
+    guild_counts = np.clip(rng.poisson(args.overlap - 1, args.users) + 1, 1, args.guilds)
+    memberships = [(int(uid), rng.choice(args.guilds, count, replace=False) + 1) for uid, count in zip(uids, guild_counts)]
+
+    counts = rng.poisson(args.transitions_per_day * args.days, args.users) + 1
+    owners = np.repeat(uids, counts)
+    offsets = rng.uniform(0, args.days * 86400, counts.sum())
+    codes = rng.choice(len(charted), counts.sum(), p=[0.4, 0.15, 0.4, 0.05])
+    order = np.argsort(offsets)
+    statuses = [
+        (int(uid), charted[code], start + datetime.timedelta(seconds=float(offset)))
+        for uid, code, offset in zip(owners[order], codes[order], offsets[order])
+    ]
+    leavers = rng.choice(uids, int(args.users * args.leave_rate), replace=False)
+    removes = sorted(
+        ((int(uid), start + datetime.timedelta(seconds=float(rng.uniform(0, args.days * 86400)))) for uid in leavers),
+        key=lambda r: r[1])
+    return statuses, removes, memberships
+
+
+async def create_partitions(pool, start, now):
+    month = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month <= now:
+        await pool.execute(f'''
+            create table if not exists statuses_{month:%Y_%m}
+            partition of statuses
+            for values from ('{month}') to ('{pop.next_month(month)}')
+        ''')
+        month = pop.next_month(month)
+
+async def bench_ingestion(pool, args, statuses, removes):
+    """Flushes the generated records in batches through the same calls as Pop.flush."""
+    cog = types.SimpleNamespace(bot=types.SimpleNamespace(retention_days=args.days))
+    for name in ('insert_to_db', 'insert_member_removes', 'update_hourly', 'update_current'):
+        setattr(cog, name, types.MethodType(getattr(pop.Pop, name), cog))
+
+    samples = []
+    pending_removes = list(removes)
+    for i in range(0, len(statuses), args.batch_size):
+        batch = statuses[i:i + args.batch_size]
+        until = batch[-1][2]
+        batch_removes = [r for r in pending_removes if r[1] <= until]
+        pending_removes = pending_removes[len(batch_removes):]
+        records = pop.record_buffer(pop.scheme['statuses'], batch)
+        removes_records = pop.record_buffer(pop.removes_scheme, batch_removes)
+
+        async def flush():
+            async with pool.acquire() as con:
+                async with con.transaction():
+                    await cog.insert_to_db(con, 'statuses', records)
+                    if batch_removes:
+                        await cog.insert_member_removes(con, removes_records)
+                    changes = [*records, *((uid, 'left_guild', t) for uid, t in batch_removes)]
+                    await cog.update_hourly(con, changes)
+                    await cog.update_current(con, [c for c in changes if c[1] != 'left_guild'])
+        await timed(samples, flush())
+
+    result = summarize(samples)
+    result['rows'] = len(statuses) + len(removes)
+    result['rows_per_second'] = result['rows'] / sum(samples)
+    return {'ingestion_flush' : result}
+
+def bench_memberships(memberships):
+    samples = []
+    index = MembershipIndex()
+    def build():
+        index.clear()
+        for uid, guilds in memberships:
+            for gid in guilds:
+                index.add(uid, int(gid))
+    for _ in range(3):
+        timed_call(samples, build)
+    return {'membership_index_build' : summarize(samples)}
+
+async def bench_queries(pool, args, sample, now):
+    """Times every query the stats commands make, and computing their results from the rows."""
+    start = now - datetime.timedelta(days=args.days)
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    samples = {name : [] for name in (
+        'query_transitions', 'query_hourly', 'query_latest', 'query_current',
+        'compute_timeline', 'compute_hour_grid', 'compute_rollup_grid')}
+    timelines = {}
+    for uid in sample:
+        async with pool.acquire() as con:
+            rows = await timed(samples['query_transitions'], con.fetch(stats.transitions_query, uid, start))
+            hourly = await timed(samples['query_hourly'], con.fetch(stats.hourly_query, uid, hour))
+            latest = await timed(samples['query_latest'], con.fetchrow(stats.latest_query, uid))
+            await timed(samples['query_current'], con.fetchrow(stats.current_query, uid))
+        timeline = timed_call(samples['compute_timeline'], lambda: Timeline(*arrays(rows), start, now))
+        timed_call(samples['compute_hour_grid'], timeline.hours)
+        timed_call(samples['compute_rollup_grid'], HourGrid.from_rollup, hourly, latest, start, now)
+        timelines[uid] = timeline
+    return {name : summarize(s) for name, s in samples.items()}, timelines
+
+def bench_renders(args, timelines):
+    """Times every chart and avatar image the bot renders, on the sampled users' data."""
+    charts.warm()
+    avatar = BytesIO()
+    Image.effect_noise((256, 256), 64).convert('RGB').save(avatar, 'png')
+    limit = 8 * 1000 * 1000
+
+    samples = {name : [] for name in (
+        'render_piestatus', 'render_barstatus', 'render_histostatus', 'render_calendarstatus',
+        'render_calendarstatuspie', 'render_hourlyupdates', 'render_thumbnail', 'render_quilt')}
+    for uid, timeline in list(timelines.items())[:args.render_sample]:
+        totals = {k : v for k, v in timeline.totals().items() if k in charts.status_names}
+        grid = timeline.hours()
+        avatar.seek(0)
+        timed_call(samples['render_piestatus'], charts.piestatus, BytesIO(avatar.getvalue()), totals)
+        timed_call(samples['render_barstatus'], charts.barstatus, f'{uid}\'s uptime in the past 30 days', totals)
+        timed_call(samples['render_histostatus'], charts.histostatus, f'{uid}\'s resturant hours', grid.histogram(0), 12, 0)
+        timed_call(samples['render_calendarstatus'], charts.calendarstatus, grid.day_shares(0), 0)
+        timed_call(samples['render_calendarstatuspie'], charts.calendarstatuspie, grid.day_shares(0), 0)
+        timed_call(samples['render_hourlyupdates'], charts.hourlyupdates, grid.day_changes(0), 0)
+        timed_call(samples['render_thumbnail'], images.thumbnail, BytesIO(avatar.getvalue()), limit)
+    for _ in range(args.render_sample):
+        timed_call(samples['render_quilt'], images.quilt, [BytesIO(avatar.getvalue()) for _ in range(50)], limit)
+    return {name : summarize(s) for name, s in samples.items() if s}
+
+
+def commit():
+    def git(*args):
+        return subprocess.run(['git', *args], capture_output=True, text=True).stdout.strip()
+    return {'sha' : git('rev-parse', 'HEAD'), 'dirty' : bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+async def main(args):
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    statuses, removes, memberships = generate(args, now)
+    results = {}
+    results.update(bench_memberships(memberships))
+
+    async def run(dsn):
+        async with scratch_database(dsn) as pool:
+            await create_partitions(pool, now - datetime.timedelta(days=args.days), now)
+            results.update(await bench_ingestion(pool, args, statuses, removes))
+            await pool.execute('analyze')
+            rng = np.random.default_rng(args.seed)
+            sample = [int(uid) for uid in rng.choice([uid for uid, guilds in memberships], min(args.query_sample, len(memberships)), replace=False)]
+            query_results, timelines = await bench_queries(pool, args, sample, now)
+            results.update(query_results)
+            results.update(bench_renders(args, timelines))
+
+    if args.dsn:
+        await run(args.dsn)
+    else:
+        async with local_postgres(args.pg_bin) as dsn:
+            await run(dsn)
+
+    report = {
+        'commit' : commit(),
+        'time' : now.isoformat(),
+        'python' : platform.python_version(),
+        'params' : {k : v for k, v in vars(args).items() if k not in ('dsn', 'output', 'pg_bin')},
+        'results' : results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--transitions-per-day', type=float, default=20)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--overlap', type=float, default=2, help='guilds per user on average')
+    parser.add_argument('--leave-rate', type=float, default=0.05, help='share of users leaving all their guilds')
+    parser.add_argument('--batch-size', type=int, default=10000, help='records per flush, like FLUSH_BATCH_SIZE')
+    parser.add_argument('--query-sample', type=int, default=100, help='users to run the stats queries for')
+    parser.add_argument('--render-sample', type=int, default=10, help='users to render the charts for')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dsn', help='use this server instead of starting one, a scratch database is created on it')
+    parser.add_argument('--pg-bin', help='directory with initdb and pg_ctl, if they are not on PATH')
+    parser.add_argument('--output', help='write the results here instead of stdout')
+    args = parser.parse_args()
+    if not args.dsn and not shutil.which(os.path.join(args.pg_bin, 'initdb') if args.pg_bin else 'initdb'):
+        parser.error('initdb not found, pass --pg-bin or --dsn')
+    asyncio.run(main(args))
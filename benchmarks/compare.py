@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+    Compares two benchmark results from benchmarks/bench.py, exiting with 1 if any got slower by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--stat', default='p50_ms', choices=('mean_ms', 'p50_ms', 'p95_ms', 'max_ms'))
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base['params'] != new['params']:
+        print('warning: the runs were made with different parameters', file=sys.stderr)
+
+    print(f"{'benchmark':<28} {base['commit']['sha'][:10]:>12} {new['commit']['sha'][:10]:>12} {'change':>8}")
+    regressed = []
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            continue
+        before, after = base['results'][name][args.stat], result[args.stat]
+        change = after / before - 1 if before else 0
+        flag = ''
+        if change > args.threshold:
+            regressed.append(name)
+            flag = ' !'
+        print(f'{name:<28} {before:>12.2f} {after:>12.2f} {change:>+8.1%}{flag}')
+
+    if regressed:
+        print(f"slower than {args.threshold:.0%}: {', '.join(regressed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,14 @@ import aiohttp
 import asyncpg
 import sys
 
+from cogs.utils.avatarstore import AvatarStore
+from cogs.utils.cache import ChartCache
+from cogs.utils.downloader import Downloader
+from cogs.utils.loopmonitor import LoopMonitor
+from cogs.utils.metrics import Registry
+from cogs.utils.render import RenderPool
+from cogs.utils.timeline import TimelineCache
+
 
 # unnecessary stuff copy pasted in mostly
 with open('config.json', 'r') as f:
@@ -30,29 +38,62 @@ ADMINS = set(config["ADMINS"])
 AVY_GUILD = config["AVY_GUILD"]
 AVY_CHANNEL = config["AVY_CHANNEL"]
 DEFAULT_PREFIX = config["DEFAULT_PREFIX"]
+LAST_VALUE_CACHE_SIZE = config.get("LAST_VALUE_CACHE_SIZE", 500000)
+JOURNAL_DIR = config.get("JOURNAL_DIR", "journal")
+JOURNAL_SYNC_INTERVAL = config.get("JOURNAL_SYNC_INTERVAL", 1)
+FLUSH_BATCH_SIZE = config.get("FLUSH_BATCH_SIZE", 10000)
+FLUSH_MAX_LATENCY = config.get("FLUSH_MAX_LATENCY", 5)
+RETENTION_DAYS = config.get("RETENTION_DAYS", 30)
+RETENTION_INTERVAL = config.get("RETENTION_INTERVAL", 3600)
+COMPACTION_INTERVAL = config.get("COMPACTION_INTERVAL", 300)
+COMPACTION_CHUNK = config.get("COMPACTION_CHUNK", 50000)
+DOWNLOAD_WORKERS = config.get("DOWNLOAD_WORKERS", 8)
+DOWNLOAD_CONNECTIONS_PER_HOST = config.get("DOWNLOAD_CONNECTIONS_PER_HOST", 8)
+DOWNLOAD_TIMEOUT = config.get("DOWNLOAD_TIMEOUT", 30)
+DOWNLOAD_RETRIES = config.get("DOWNLOAD_RETRIES", 5)
+AVY_POST_LOOKAHEAD = config.get("AVY_POST_LOOKAHEAD", 30)
+AVATAR_STORE_DIR = config.get("AVATAR_STORE_DIR", "avatars")
+AVATAR_STORE_SIZE = config.get("AVATAR_STORE_SIZE", 2000000000)
+RENDER_WORKERS = config.get("RENDER_WORKERS", 4)
+RENDER_MAX_PENDING = config.get("RENDER_MAX_PENDING", 16)
+RENDER_TIMEOUT = config.get("RENDER_TIMEOUT", 60)
+CHART_CACHE_SIZE = config.get("CHART_CACHE_SIZE", 256)
+CHART_CACHE_TTL = config.get("CHART_CACHE_TTL", 600)
+TIMELINE_CACHE_SIZE = config.get("TIMELINE_CACHE_SIZE", 64000000)
+METRICS_HOST = config.get("METRICS_HOST", "127.0.0.1")
+# set to 0 to turn off the metrics endpoint
+METRICS_PORT = config.get("METRICS_PORT", 9100)
+LOOP_MONITOR_INTERVAL = config.get("LOOP_MONITOR_INTERVAL", 0.5)
+LOOP_STALL_THRESHOLD = config.get("LOOP_STALL_THRESHOLD", 0.25)
+LOOP_REPORT_INTERVAL = config.get("LOOP_REPORT_INTERVAL", 300)
+
+logger = logging.getLogger('koishi')
 
-logging.basicConfig(level=logging.INFO)
 
-log_formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+def setup_logging():
+    """
+        Only when run as the bot, the render workers import this module too and must not truncate the logs.
+    """
+    logging.basicConfig(level=logging.INFO)
 
-discord_logger = logging.getLogger('discord')
+    log_formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
 
-discord_file_handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-discord_file_handler.setFormatter(log_formatter)
-discord_logger.addHandler(discord_file_handler)
+    discord_logger = logging.getLogger('discord')
 
-logger = logging.getLogger('koishi')
+    discord_file_handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
+    discord_file_handler.setFormatter(log_formatter)
+    discord_logger.addHandler(discord_file_handler)
 
-console_log_handler = logging.StreamHandler(sys.stdout)
-console_log_handler.setFormatter(log_formatter)
-logger.addHandler(console_log_handler)
+    console_log_handler = logging.StreamHandler(sys.stdout)
+    console_log_handler.setFormatter(log_formatter)
+    logger.addHandler(console_log_handler)
 
-koishi_file_handler = logging.FileHandler(filename='koishi.log', encoding='utf-8', mode='w')
-koishi_file_handler.setFormatter(log_formatter)
-logger.addHandler(koishi_file_handler)
+    koishi_file_handler = logging.FileHandler(filename='koishi.log', encoding='utf-8', mode='w')
+    koishi_file_handler.setFormatter(log_formatter)
+    logger.addHandler(koishi_file_handler)
 
-coglogger = logging.getLogger('cogs')
-coglogger.addHandler(koishi_file_handler)
+    coglogger = logging.getLogger('cogs')
+    coglogger.addHandler(koishi_file_handler)
 
 description = '''Lies and slander follow'''
 bot = commands.AutoShardedBot(command_prefix=DEFAULT_PREFIX, description=description, intents=discord.Intents.all())
@@ -61,6 +102,23 @@ bot.avy_channel = AVY_CHANNEL
 bot.admins = ADMINS
 bot.bot_invite = BOT_INVITE
 bot.server_invite = SERVER_INVITE
+bot.last_value_cache_size = LAST_VALUE_CACHE_SIZE
+bot.journal_dir = JOURNAL_DIR
+bot.journal_sync_interval = JOURNAL_SYNC_INTERVAL
+bot.flush_batch_size = FLUSH_BATCH_SIZE
+bot.flush_max_latency = FLUSH_MAX_LATENCY
+bot.retention_days = RETENTION_DAYS
+bot.retention_interval = RETENTION_INTERVAL
+bot.compaction_interval = COMPACTION_INTERVAL
+bot.compaction_chunk = COMPACTION_CHUNK
+bot.download_workers = DOWNLOAD_WORKERS
+bot.download_retries = DOWNLOAD_RETRIES
+bot.avy_post_lookahead = AVY_POST_LOOKAHEAD
+bot.chart_cache = ChartCache(CHART_CACHE_SIZE, CHART_CACHE_TTL)
+# the stats commands look at the last 30 days
+bot.timelines = TimelineCache(TIMELINE_CACHE_SIZE, 30)
+bot.metrics = Registry()
+bot.loop_monitor = LoopMonitor(bot.loop, bot.metrics, LOOP_MONITOR_INTERVAL, LOOP_STALL_THRESHOLD, LOOP_REPORT_INTERVAL)
 
 
 @bot.event
@@ -109,6 +167,8 @@ async def create_pool(uri, **kwargs):
 
 
 async def run():
+    bot.renderer = RenderPool(RENDER_WORKERS, RENDER_MAX_PENDING, RENDER_TIMEOUT)
+    await bot.renderer.warm()
     try:
         pool = await create_pool(DB_URI)
         logger.info('Connected to postgresql server')
@@ -116,7 +176,17 @@ async def run():
         logger.exception('Could not set up postgresql')
         return
     bot.session = aiohttp.ClientSession()
+    bot.avatar_store = AvatarStore(AVATAR_STORE_DIR, AVATAR_STORE_SIZE)
+    bot.downloader = Downloader(DOWNLOAD_CONNECTIONS_PER_HOST, DOWNLOAD_TIMEOUT)
     bot.pool = pool
+    bot.metrics_runner = None
+    if METRICS_PORT:
+        try:
+            bot.metrics_runner = await bot.metrics.serve(METRICS_HOST, METRICS_PORT)
+            logger.info(f'Serving metrics on {METRICS_HOST}:{METRICS_PORT}')
+        except OSError:
+            logger.exception('Could not start the metrics endpoint')
+    bot.loop_monitor.start()
     for extension in STARTUP_EXTENSIONS:
         bot.load_extension(extension)
     bot.start_time = datetime.datetime.utcnow()
@@ -125,9 +195,15 @@ async def run():
     except KeyboardInterrupt:
         await bot.logout()
     finally:
+        bot.loop_monitor.stop()
+        if bot.metrics_runner is not None:
+            await bot.metrics_runner.cleanup()
+        await bot.downloader.close()
+        bot.renderer.close()
         loop.close()
         
     
 if __name__ == "__main__":
+    setup_logging()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run())
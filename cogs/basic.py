@@ -30,6 +30,39 @@ class Basic(commands.Cog):
         
         await ctx.send(f'for {time} so far')
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def metrics(self, ctx, prefix = ''):
+        """Summarises the metrics whose names start with prefix, koishi_ can be left out."""
+        if prefix and not prefix.startswith('koishi_'):
+            prefix = f'koishi_{prefix}'
+        lines = self.bot.metrics.summary(prefix)
+        if not lines:
+            return await ctx.send('Nothing recorded yet.')
+        paginator = commands.Paginator()
+        for line in lines:
+            paginator.add_line(line[:1900])
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def looplag(self, ctx, stall : int = None):
+        """Shows event loop lag percentiles and the recent stalls, or the stack of one of them."""
+        monitor = self.bot.loop_monitor
+        stalls = list(monitor.stalls)[::-1]
+        if stall is not None:
+            if not 1 <= stall <= len(stalls):
+                return await ctx.send(f'There are {len(stalls)} recent stalls.')
+            s = stalls[stall - 1]
+            stack = s.stack or 'No stack, the watchdog did not catch it in time.'
+            return await ctx.send(f'{s.seconds*1000:.0f}ms in {s.task}\n```py\n{stack[-1900:]}```')
+        lines = [f'lag {monitor.format_percentiles()}']
+        utcnow = datetime.datetime.utcnow()
+        for i, s in enumerate(stalls, 1):
+            lines.append(f'{i}. {s.seconds*1000:.0f}ms in {s.task}, {pretty.delta_to_str(datetime.datetime.utcfromtimestamp(s.started), utcnow)} ago')
+        await ctx.send('\n'.join(lines))
+
     
 def setup(bot):
     bot.add_cog(Basic(bot))
@@ -2,15 +2,23 @@ import asyncio
 import datetime
 import logging
 import os.path
+import re
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 
 import aiohttp
+import asyncpg
 import discord
 from discord.ext import commands
 from PIL import Image
-from yarl import URL
 
-from .utils import images
+from .utils import images, packing, timeline
+from .utils.cache import AvatarHashSet, LastValueCache
+from .utils.columns import RecordBuffer
+from .utils.journal import Journal
+from .utils.membership import MembershipIndex
 
 logger = logging.getLogger(__name__)
 
@@ -64,197 +72,796 @@ scheme2 = {
             'value' : 'status',
             },
          }
+removes_scheme = {
+            'uid' : 'BIGINT',
+            'time' : 'TIMESTAMP WITHOUT TIME ZONE'
+            }
+status_enum = ('online', 'offline', 'invisible', 'dnd', 'idle', 'cog_offline', 'cog_online', 'left_guild')
+
+
+db_errors = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+# errors that say nothing about the records, anything else while writing a segment counts against it
+transient_errors = (OSError, asyncio.TimeoutError, asyncpg.InterfaceError)
+# a segment failing this many flushes in a row is moved out of the journal
+max_segment_failures = 3
+max_avatar_attempts = 5
+
+
+class SegmentRejected(Exception):
+    '''Raised from the error writing a batch of segments, names are the record types whose segments are to blame.'''
+    def __init__(self, names):
+        super().__init__(names)
+        self.names = names
+
+
+def record_buffer(columns, records=()):
+    return RecordBuffer(columns, records, enums={'status' : status_enum})
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
 
 
 class Pop(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.logger = logging.getLogger('koishi')
-        self.bg_tasks = {recordtype : self.bot.loop.create_task(self.batching_task(recordtype)) for recordtype in scheme.keys()}
+        self.pending_since = self.bot.loop.time() if self.pending_count() or any(j.sealed for j in self.bot.journals.values()) else None
+        # when the oldest records not yet committed were taken off the queues
+        self.unflushed_since = time.monotonic() if any(j.sealed for j in self.bot.journals.values()) else None
+        self.flush_wanted = asyncio.Event()
+        self.flush_task = self.bot.loop.create_task(self.flush_scheduler())
         self.sync_task = self.bot.loop.create_task(self.sync())
         self.post_avy_task = self.bot.loop.create_task(self.batch_post_avatars())
+        self.known_avatars_task = self.bot.loop.create_task(self.load_known_avatars())
+        self.download_queue = asyncio.Queue(maxsize=self.bot.download_workers)
         self.dl_avys_task = self.bot.loop.create_task(self.dl_avys())
-        self.batch_remove_task = self.bot.loop.create_task(self.batch_member_remove())
+        self.download_tasks = [self.bot.loop.create_task(self.download_worker()) for _ in range(self.bot.download_workers)]
+        self.journal_task = self.bot.loop.create_task(self.sync_journals())
+        self.retention_task = self.bot.loop.create_task(self.purge_statuses_task())
+        self.compaction_progress = {}
+        self.segment_failures = {}
+        self.avatar_attempts = {}
+        self.compaction_task = self.bot.loop.create_task(self.compact_history())
         self.bot.loop.create_task(self.sync())
+        self.register_metrics()
+
+    def register_metrics(self):
+        metrics = self.bot.metrics
+        self.queued = metrics.counter('koishi_queued_records_total', 'Records queued for the db.')
+        self.skipped = metrics.counter('koishi_unchanged_records_total', 'Records dropped for repeating the last value seen.')
+        self.flushes = metrics.counter('koishi_flushes_total', 'Flushes by result.')
+        self.flushed = metrics.counter('koishi_flushed_records_total', 'Records written by flushes.')
+        self.flush_seconds = metrics.histogram('koishi_flush_seconds', 'Time taken by flushes that had anything to write.')
+        self.db_seconds = metrics.histogram('koishi_db_write_seconds', 'Time taken writing each part of a flush.')
+        self.compaction_seconds = metrics.histogram('koishi_compaction_seconds', 'Time taken compacting each history table.')
+        metrics.gauge('koishi_pending_records', 'Records waiting for the next flush.',
+            func=lambda: {**{name : len(records) for name, records in self.bot.pending_updates.items()}, 'member_removes' : len(self.bot.pending_removes)},
+            label='recordtype')
+        metrics.gauge('koishi_journal_segments', 'Sealed journal segments not in the db yet.',
+            func=lambda: {name : len(journal.sealed) for name, journal in self.bot.journals.items()}, label='recordtype')
+        metrics.gauge('koishi_last_values', 'Keys in the last value caches.',
+            func=lambda: {name : len(cache) for name, cache in self.bot.last_values.items()}, label='recordtype')
+        metrics.gauge('koishi_avatar_backlog', 'Avatars waiting to be downloaded.', func=lambda: len(self.bot.avy_urls))
+        metrics.gauge('koishi_download_queue', 'Avatars handed to the download workers.', func=lambda: self.download_queue.qsize())
+        metrics.gauge('koishi_avatar_posting_queue', 'Downloaded avatars waiting to be posted.', func=lambda: self.bot.avy_posting_queue.qsize())
+        metrics.counter('koishi_downloads_total', 'Avatar download counters.', func=lambda: dict(self.bot.downloader.stats), label='stat')
+        metrics.gauge('koishi_timeline_cache_bytes', 'Bytes held by the timeline cache.', func=lambda: self.bot.timelines.size)
+        metrics.gauge('koishi_chart_cache_entries', 'Rendered charts in the chart cache.', func=lambda: len(self.bot.chart_cache))
 
 
     def cog_unload(self):
         logger.info('die')
         utcnow = datetime.datetime.utcnow()
         self.post_avy_task.cancel()
+        self.known_avatars_task.cancel()
         self.dl_avys_task.cancel()
-        self.batch_remove_task.cancel()
-        for recordtype, task in self.bg_tasks.items():
-            logger.info(f'canceling {recordtype}')
+        for task in self.download_tasks:
             task.cancel()
+        self.journal_task.cancel()
+        self.retention_task.cancel()
+        self.compaction_task.cancel()
+        self.flush_task.cancel()
         self.bot.loop.create_task(self.cog_log(False, utcnow))
 
     async def cog_log(self, start, time):
         event = 'cog_online' if start else 'cog_offline'
         query = '''insert into cog_log (event, time) values ($1, $2)'''
         await self.bot.pool.execute(query, event, time)
+        # cog_log rows are part of everyone's status history
+        self.bot.chart_cache.clear()
+        self.bot.timelines.clear()
 
-    async def batching_task(self, recordtype, interval : int = 5):
-        logger.info(f'started {recordtype} task')
+    async def flush_scheduler(self):
+        logger.info('started flush task')
         try:
-            interval = min(max(1,interval),60)
+            try:
+                await self.create_partitions()
+            except db_errors:
+                logger.exception('creating statuses partitions failed')
             await self.bot.wait_until_ready()
+            failures = 0
+            while True:
+                await self.wait_for_flush()
+                try:
+                    await self.flush()
+                    failures = 0
+                except Exception:
+                    failures += 1
+                    logger.exception(f'flush failed unexpectedly, {failures} in a row')
+                    # the segments are still in the journal, make sure they are retried without waiting for new records
+                    if self.pending_since is None:
+                        self.pending_since = self.bot.loop.time()
+                    await asyncio.sleep(min(2 ** failures, 60))
+        except asyncio.CancelledError:
+            logger.warning('flush task was cancelled')
+            await self.flush()
+            backlog = sum(len(journal.sealed) for journal in self.bot.journals.values())
+            if backlog:
+                logger.error(f'{backlog} segments left in the journal')
+        logger.info('exited flush task')
+
+    def pending_count(self):
+        return sum(len(records) for records in self.bot.pending_updates.values()) + len(self.bot.pending_removes)
+
+    async def wait_for_flush(self):
+        """
+            Waits until flush_batch_size records are queued or the oldest one has waited flush_max_latency seconds.
+        """
+        while self.pending_count() < self.bot.flush_batch_size:
+            timeout = None
+            if self.pending_since is not None:
+                timeout = self.pending_since + self.bot.flush_max_latency - self.bot.loop.time()
+                if timeout <= 0:
+                    return
+            self.flush_wanted.clear()
+            try:
+                await asyncio.wait_for(self.flush_wanted.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    def mark_pending(self):
+        if self.pending_since is None:
+            self.pending_since = self.bot.loop.time()
+            # wake wait_for_flush so it starts counting down flush_max_latency from now
+            self.flush_wanted.set()
+        elif self.pending_count() >= self.bot.flush_batch_size:
+            self.flush_wanted.set()
+
+    async def sync_journals(self):
+        logger.info('started journal sync task')
+        try:
             while True:
-                await asyncio.sleep(interval)
-                await self.insert_to_db(recordtype)
+                await asyncio.sleep(self.bot.journal_sync_interval)
+                for journal in self.bot.journals.values():
+                    await journal.sync()
         except asyncio.CancelledError:
-            logger.warning(f'Batching task for {recordtype} was cancelled')
-            await self.insert_to_db(recordtype)
-            if self.bot.pending_updates[recordtype]:
-                logger.error(f'{len(self.bot.pending_updates[recordtype])} status updates DIED')
-        logger.info(f'exited {recordtype} task')
-
-    async def insert_to_db(self, recordtype):
-        to_insert = self.bot.pending_updates[recordtype][:]
-        if len(to_insert) == 0:
+            logger.warning('journal sync task was cancelled')
+            for journal in self.bot.journals.values():
+                await journal.sync()
+
+    async def flush(self):
+        """
+            Writes everything queued, along with anything left in the journals.
+            Each flush seals a segment with the same sequence number in every journal, those are written together in one
+            transaction, in order. The transaction also records them in applied_segments,
+            so one left in the journal by a crash after the commit is skipped. A segment is removed once its transaction commits.
+            On a connection error the rest waits for the next flush. A segment that is rejected
+            is retried on the next flushes and moved out of the journal after max_segment_failures.
+        """
+        fresh = {}
+        for recordtype in scheme.keys():
+            fresh[recordtype] = (self.bot.pending_updates[recordtype], self.bot.last_values[recordtype].take_misses())
+            self.bot.pending_updates[recordtype] = record_buffer(scheme[recordtype])
+        fresh['member_removes'] = (self.bot.pending_removes, None)
+        self.bot.pending_removes = record_buffer(removes_scheme)
+        self.pending_since = None
+
+        current = {name : journal.rotate() for name, journal in self.bot.journals.items()}
+        batches = sorted({seq for journal in self.bot.journals.values() for seq in journal.sealed})
+        if not batches:
+            return
+        if self.unflushed_since is None:
+            self.unflushed_since = time.monotonic()
+        for journal in self.bot.journals.values():
+            await journal.sync()
+
+        for seq in batches:
+            names = [name for name, journal in self.bot.journals.items() if seq in journal.sealed]
+            start = time.perf_counter()
+            try:
+                written, changed = await self.flush_batch(seq, names, current, fresh)
+            except (*transient_errors, SegmentRejected) as e:
+                self.flushes.inc(result='failed')
+                self.flush_seconds.observe(time.perf_counter() - start, result='failed')
+                if self.pending_since is None:
+                    self.pending_since = self.bot.loop.time()
+                if isinstance(e, SegmentRejected):
+                    self.segment_failed(e.names, seq, e.__cause__)
+                else:
+                    backlog = sum(len(journal.sealed) for journal in self.bot.journals.values())
+                    logger.exception(f'flush failed, keeping {backlog} segments in the journal')
+                # later segments wait, so that each user's changes still reach the rollups in order
+                return
+
+            self.flushes.inc(result='ok')
+            self.flush_seconds.observe(time.perf_counter() - start, result='ok')
+            for name, count in written.items():
+                self.flushed.inc(count, recordtype=name)
+            # only once committed, a chart rendered in between would otherwise be cached without the new rows
+            self.bot.chart_cache.invalidate(changed)
+            # timelines fetched while these rows were neither queued nor committed could have missed them
+            self.bot.timelines.invalidate(changed, self.unflushed_since)
+            for name in names:
+                self.segment_failures.pop((name, seq), None)
+                self.bot.journals[name].remove(seq)
+        self.unflushed_since = None
+
+    async def flush_batch(self, seq, names, current, fresh):
+        """
+            Writes the segments numbered seq of the journals in names in one transaction.
+            Returns the rows written by record type and the users whose statuses changed.
+            Any error that is not transient is raised as SegmentRejected naming the segments to blame.
+        """
+        written = {}
+        status_changes = []
+        failed = names
+        try:
+            async with self.bot.pool.acquire() as con:
+                async with con.transaction():
+                    # committed before a crash left them in the journal
+                    applied = {r['recordtype'] for r in await con.fetch('select recordtype from applied_segments where seq = $1', seq)}
+                    for name in names:
+                        if name in applied:
+                            logger.info(f'{name} segment {seq} was already written, skipping it')
+                            continue
+                        failed = [name]
+                        columns = removes_scheme if name == 'member_removes' else scheme[name]
+                        if seq == current[name]:
+                            records, misses = fresh[name]
+                        else:
+                            records = record_buffer(columns, self.bot.journals[name].read(seq))
+                            # the cache misses of an earlier flush were taken when it ran, so every key is checked again
+                            misses = None if name == 'member_removes' else {self.record_key(name, record) for record in records}
+                        with self.db_seconds.time(part=name):
+                            if name == 'member_removes':
+                                await self.insert_member_removes(con, records)
+                            else:
+                                records = await self.insert_to_db(con, name, records, misses)
+                        written[name] = written.get(name, 0) + len(records)
+                        if name == 'statuses':
+                            status_changes.extend(records)
+                        elif name == 'member_removes':
+                            status_changes.extend((uid, 'left_guild', at) for uid, at in records)
+                    failed = [name for name in names if name in ('statuses', 'member_removes')] or names
+                    with self.db_seconds.time(part='status_hourly'):
+                        await self.update_hourly(con, status_changes)
+                    with self.db_seconds.time(part='status_current'):
+                        await self.update_current(con, [c for c in status_changes if c[1] != 'left_guild'])
+                    await con.execute('''
+                        insert into applied_segments (recordtype, seq)
+                        select recordtype, seq from unnest($1::text[], $2::bigint[]) as x(recordtype, seq)
+                    ''', [name for name in names if name not in applied], [seq for name in names if name not in applied])
+        except transient_errors:
+            raise
+        except Exception as e:
+            raise SegmentRejected(failed) from e
+        return written, {uid for uid, status, at in status_changes}
+
+    def segment_failed(self, names, seq, error):
+        for name in names:
+            failures = self.segment_failures.get((name, seq), 0) + 1
+            if failures < max_segment_failures:
+                self.segment_failures[name, seq] = failures
+                logger.error(f'{name} segment {seq} was rejected ({failures}/{max_segment_failures}): {error!r}')
+                continue
+            self.segment_failures.pop((name, seq), None)
+            path = self.bot.journals[name].bury(seq)
+            logger.error(f'{name} segment {seq} was rejected {failures} times, moved it to {path}: {error!r}')
+
+    async def update_hourly(self, con, changes):
+        """
+            Adds status changes, (uid, status, time) rows, to status_hourly.
+            The first change of each user closes the interval of the last one already flushed,
+            the last change stays open until the next flush.
+        """
+        if not changes:
+            return
+        first = {}
+        for uid, status, at in sorted(changes, key=lambda c: c[2]):
+            first.setdefault(uid, at)
+        previous = await con.fetch('''
+            select b.uid, p.status, p.first_seen
+            from unnest($1::bigint[], $2::timestamp[]) as b(uid, time)
+            cross join lateral (
+                (select status, first_seen
+                from statuses
+                where uid=b.uid and first_seen < b.time
+                order by first_seen desc
+                limit 1)
+                union all
+                (select 'left_guild', time
+                from member_removes
+                where uid=b.uid and time < b.time
+                order by time desc
+                limit 1)
+                order by first_seen desc
+                limit 1
+            ) p
+        ''', list(first.keys()), list(first.values()))
+        previous = [tuple(row) for row in previous]
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.bot.retention_days)
+        # cog_log and uid 0 statuses cut into everyone's intervals, as they do in the timelines the stats commands build.
+        # time before cutoff is not rolled up, so of the events before it only the latest matters
+        shared = await con.fetch('''
+            with events as (
+                select status::text, first_seen
+                from statuses
+                where uid=0 and first_seen > $1 and first_seen < $2
+                union all
+                select event::text, time
+                from cog_log
+                where time > $1 and time < $2
+            )
+            select * from events where first_seen >= $3
+            union all
+            (select * from events where first_seen < $3 order by first_seen desc limit 1)
+        ''', min(at for uid, status, at in (*previous, *changes)), max(at for uid, status, at in changes), cutoff)
+        rows = timeline.rollup(previous, changes, cutoff, [tuple(row) for row in shared])
+        if not rows:
+            return
+        await con.execute('''
+            insert into status_hourly (uid, hour, status, seconds, transitions)
+            select uid, hour, status::status, seconds, transitions
+            from unnest($1::bigint[], $2::timestamp[], $3::text[], $4::float8[], $5::int[])
+                as x(uid, hour, status, seconds, transitions)
+            on conflict (uid, hour, status) do update
+            set
+                seconds = status_hourly.seconds + excluded.seconds,
+                transitions = status_hourly.transitions + excluded.transitions
+        ''', *(list(col) for col in zip(*rows)))
+
+    async def update_current(self, con, changes):
+        """
+            Moves status_current along the status changes, (uid, status, time) rows, of each user.
+            since is when the user changed to their status, last_offline when they last changed from offline to anything else.
+            cog_log and uid 0 statuses between a user's changes change their status too, as they do in a Timeline.
+        """
+        if not changes:
             return
-        self.bot.pending_updates[recordtype] = []
+        first = {}
+        for uid, status, at in sorted(changes, key=lambda c: c[2]):
+            first.setdefault(uid, at)
+        uids = list(first)
+        current = {row['uid'] : [row['status'], row['since'], row['last_offline']] for row in await con.fetch('''
+            select uid, status::text, since, last_offline
+            from status_current
+            where uid = any($1::bigint[])
+        ''', uids)}
+        # the latest event before the batch gives the status a user has when their first change comes,
+        # a user who was offline before it also needs the first one after, which ended that
+        shared = [tuple(row) for row in await con.fetch('''
+            with events as (
+                select status::text, first_seen
+                from statuses
+                where uid=0 and first_seen < $2
+                union all
+                select event::text, time
+                from cog_log
+                where time < $2
+            )
+            (select * from events where first_seen < $1 order by first_seen desc limit 1)
+            union all
+            select * from events where first_seen >= $1
+            order by first_seen
+        ''', min(first.values()), max(at for uid, status, at in changes))]
+        offline = [uid for uid, state in current.items() if state[0] == 'offline']
+        ended = {row['uid'] : (row['status'], row['first_seen']) for row in await con.fetch('''
+            select b.uid, e.status, e.first_seen
+            from unnest($1::bigint[], $2::timestamp[], $3::timestamp[]) as b(uid, since, time)
+            cross join lateral (
+                (select status::text, first_seen
+                from statuses
+                where uid=0 and first_seen > b.since and first_seen < b.time
+                order by first_seen
+                limit 1)
+                union all
+                (select event::text, time
+                from cog_log
+                where time > b.since and time < b.time
+                order by time
+                limit 1)
+                order by first_seen
+                limit 1
+            ) e
+        ''', offline, [current[uid][1] for uid in offline], [first[uid] for uid in offline])} if offline else {}
+        times = [at for status, at in shared]
+
+        def move(state, status, at):
+            if status != state[0]:
+                if state[0] == 'offline':
+                    state[2] = at
+                state[0], state[1] = status, at
+
+        for uid, event in ended.items():
+            move(current[uid], *event)
+        for uid, status, at in sorted(changes, key=lambda c: c[2]):
+            state = current.setdefault(uid, [None, None, None])
+            if state[1] is not None:
+                for event in shared[bisect_right(times, state[1]):bisect_left(times, at)]:
+                    move(state, *event)
+            move(state, status, at)
+        await con.execute('''
+            insert into status_current (uid, status, since, last_offline)
+            select uid, status::status, since, last_offline
+            from unnest($1::bigint[], $2::text[], $3::timestamp[], $4::timestamp[]) as x(uid, status, since, last_offline)
+            on conflict (uid) do update
+            set
+                status = excluded.status,
+                since = excluded.since,
+                last_offline = excluded.last_offline
+        ''', uids, *(list(col) for col in zip(*(current[uid] for uid in uids))))
+
+    async def create_partitions(self):
+        """
+            Creates the statuses partitions for this month and the next, before anything is flushed into them.
+        """
+        month = datetime.datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for start in (month, next_month(month)):
+            await self.bot.pool.execute(f'''
+                create table if not exists statuses_{start:%Y_%m}
+                partition of statuses
+                for values from ('{start}') to ('{next_month(start)}')
+            ''')
+
+    async def purge_statuses_task(self):
+        logger.info('started statuses retention task')
+        try:
+            await self.bot.wait_until_ready()
+            while True:
+                try:
+                    await self.create_partitions()
+                    await self.purge_statuses()
+                except db_errors:
+                    logger.exception('purging statuses failed')
+                await asyncio.sleep(self.bot.retention_interval)
+        except asyncio.CancelledError:
+            logger.warning('statuses retention task was cancelled')
+
+    async def purge_statuses(self):
+        """
+            Drops the statuses partitions that ended more than retention_days ago.
+            Rows of users with keep set in presence_whitelist are moved to statuses_archive first.
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.bot.retention_days)
+        archive = '''
+            insert into statuses_archive (ref, uid, status, first_seen)
+            select ref, uid, status, first_seen
+            from {}
+            where
+                uid in (select uid from presence_whitelist where keep) and
+                first_seen < $1
+            on conflict (ref) do nothing
+        '''
         async with self.bot.pool.acquire() as con:
-            result = await con.copy_records_to_table(recordtype, records=to_insert, columns=scheme[recordtype].keys(),schema_name='koi_test')
-            if len(to_insert) > 20000 and recordtype != 'statuses':
-                key = scheme2[recordtype]['key']
-                value = scheme2[recordtype]['value']
-                query = f'''
-                    delete from
-                        {recordtype}
-                    where
-                        ref in (
-                            select
-                                ref
-                            from (
-                                select
-                                    ref,
-                                    {value},
-                                    lead({value}) over (partition by {key} order by first_seen desc) as r_last,
-                                    first_seen
+            partitions = await con.fetch('''
+                select c.relname
+                from pg_inherits i
+                join pg_class c on c.oid = i.inhrelid
+                where i.inhparent = 'statuses'::regclass
+            ''')
+            for row in partitions:
+                name = row['relname']
+                match = re.fullmatch(r'statuses_(\d{4})_(\d{2})', name)
+                if match is None or next_month(datetime.datetime(int(match[1]), int(match[2]), 1)) > cutoff:
+                    continue
+                async with con.transaction():
+                    archived = await con.execute(archive.format(name), cutoff)
+                    await con.execute(f'alter table statuses detach partition {name}')
+                    await con.execute(f'drop table {name}')
+                logger.info(f'dropped statuses partition {name}, archived {archived.split()[-1]} rows')
+
+            # the default partition only sees rows outside of the monthly ones, so it is purged row by row
+            async with con.transaction():
+                await con.execute(archive.format('statuses_default'), cutoff)
+                await con.execute('delete from statuses_default where first_seen < $1', cutoff)
+            await con.execute('delete from status_hourly where hour < $1', cutoff)
+            await con.execute('delete from applied_segments where applied_at < $1', cutoff)
+
+    @staticmethod
+    def record_key(recordtype, record):
+        width = len(scheme2[recordtype]['key'].split(', '))
+        return record[0] if width == 1 else tuple(record[:width])
+
+    def queue_update(self, recordtype, record):
+        """
+            Queues a record unless it repeats the last value seen for its key.
+            Returns whether the record was queued.
+        """
+        width = len(scheme2[recordtype]['key'].split(', '))
+        if not self.bot.last_values[recordtype].changed(self.record_key(recordtype, record), record[width]):
+            self.skipped.inc(recordtype=recordtype)
+            return False
+        self.queued.inc(recordtype=recordtype)
+        self.bot.pending_updates[recordtype].append(record)
+        self.bot.journals[recordtype].append(record)
+        if recordtype == 'statuses':
+            self.bot.timelines.append(*record)
+        self.mark_pending()
+        return True
+
+    def queue_remove(self, uid, utcnow):
+        self.queued.inc(recordtype='member_removes')
+        self.bot.pending_removes.append((uid, utcnow))
+        self.bot.journals['member_removes'].append((uid, utcnow))
+        self.bot.timelines.append(uid, 'left_guild', utcnow)
+        self.mark_pending()
+
+    async def drop_unchanged(self, con, recordtype, records, misses):
+        """
+            Keys that missed the cache were queued unchecked.
+            Drops their first record in the batch if it repeats the latest value in the db.
+        """
+        key = scheme2[recordtype]['key']
+        value = scheme2[recordtype]['value']
+        cols = key.split(', ')
+        unnest = ', '.join(f'${i+1}::bigint[]' for i in range(len(cols)))
+        query = f'''
+            select distinct on ({key})
+                {key}, {value} as value
+            from {recordtype}
+            where
+                ({key}) in (select * from unnest({unnest}))
+            order by {key}, first_seen desc
+        '''
+        misses = list(misses)
+        last = {}
+        batch_size = 50000
+        for i in range(0, len(misses), batch_size):
+            chunk = misses[i:i+batch_size]
+            args = [list(col) for col in zip(*chunk)] if len(cols) > 1 else [chunk]
+            for r in await con.fetch(query, *args):
+                last[tuple(r[c] for c in cols) if len(cols) > 1 else r[key]] = r['value']
+
+        width = len(cols)
+        checked = set()
+        kept = record_buffer(scheme[recordtype])
+        for record in records:
+            k = self.record_key(recordtype, record)
+            if k in last and k not in checked:
+                checked.add(k)
+                if last[k] == record[width]:
+                    continue
+            kept.append(record)
+        return kept
+
+    async def insert_to_db(self, con, recordtype, records, misses=None):
+        """
+            Copies records into their table, returning the ones that were written.
+        """
+        if misses and recordtype != 'statuses':
+            # statuses are always kept on a miss, a status after a cog_log or member_removes event starts a new interval.
+            records = await self.drop_unchanged(con, recordtype, records, misses)
+        if len(records) == 0:
+            return records
+        await con.copy_records_to_table(recordtype, records=records, columns=scheme[recordtype].keys(),schema_name='koi_test')
+        return records
+
+    async def compact_history(self):
+        logger.info('started compaction task')
+        try:
+            await self.bot.wait_until_ready()
+            while True:
+                for recordtype in scheme2.keys():
+                    if recordtype == 'statuses':
+                        continue
+                    try:
+                        with self.compaction_seconds.time(recordtype=recordtype):
+                            await self.compact(recordtype)
+                    except db_errors:
+                        logger.exception(f'compacting {recordtype} failed')
+                await asyncio.sleep(self.bot.compaction_interval)
+        except asyncio.CancelledError:
+            logger.warning('compaction task was cancelled')
+
+    async def compact(self, recordtype):
+        """
+            Deletes rows that repeat the previous value for their key, looking only at rows inserted since the last checkpoint.
+            Works through them compaction_chunk refs at a time, moving the checkpoint after each chunk.
+        """
+        key = scheme2[recordtype]['key']
+        value = scheme2[recordtype]['value']
+        query = f'''
+            delete from
+                {recordtype}
+            where
+                ref in (
+                    select
+                        ref
+                    from (
+                        select
+                            ref,
+                            {value},
+                            lag({value}) over w as r_last,
+                            lag(ref) over w as ref_last
+                        from {recordtype}
+                        where
+                            ({key}) in (
+                                select {key}
                                 from {recordtype}
-                                order by first_seen desc
-                            ) subtable
-                            where
-                                {value} = r_last
-                        )
-                '''
-                await con.execute(query)
+                                where ref > $1 and ref <= $2
+                            )
+                        window w as (partition by {key} order by first_seen, ref)
+                    ) subtable
+                    where
+                        ref > $1 and ref <= $2 and
+                        ref_last is not null and
+                        {value} is not distinct from r_last
+                )
+        '''
+        async with self.bot.pool.acquire() as con:
+            checkpoint = await con.fetchval('select ref from compaction_checkpoints where recordtype = $1', recordtype) or 0
+            high = await con.fetchval(f'select max(ref) from {recordtype}') or 0
+            start = checkpoint
+            deleted = 0
+            while checkpoint < high:
+                end = min(checkpoint + self.bot.compaction_chunk, high)
+                async with con.transaction():
+                    result = await con.execute(query, checkpoint, end)
+                    await con.execute('''
+                        insert into compaction_checkpoints (recordtype, ref)
+                        values ($1, $2)
+                        on conflict (recordtype) do update
+                        set ref = $2
+                    ''', recordtype, end)
+                deleted += int(result.split()[-1])
+                checkpoint = end
+                self.compaction_progress[recordtype] = (checkpoint, high, deleted)
+                logger.debug(f'compacted {recordtype} up to ref {checkpoint} of {high}, {deleted} deleted')
+            if checkpoint != start:
+                logger.info(f'compacted {recordtype} refs {start} to {checkpoint}, {deleted} deleted')
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def compaction(self, ctx):
+        """Shows how far the compaction task has got through each history table."""
+        if not self.compaction_progress:
+            return await ctx.send('Nothing compacted yet.')
+        lines = [f'{recordtype}: ref {checkpoint}/{high}, {deleted} deleted' for recordtype, (checkpoint, high, deleted) in self.compaction_progress.items()]
+        await ctx.send('\n'.join(lines))
 
-    async def insert_to_db_2(self, recordtype):
-        to_insert = self.bot.pending_updates[recordtype][:]
-        if len(to_insert) == 0:
+    async def load_known_avatars(self):
+        """
+            Streams every archived avatar hash into bot.known_avatars, once per process.
+        """
+        if self.bot.known_avatars.hydrated:
             return
-        self.bot.pending_updates[recordtype] = []
-        names = scheme[recordtype].keys()
-        cols = ', '.join(names)
-        types = ', '.join(f'{k} {v}' for k, v in scheme[recordtype].items())
-        transformed = [{col : row[i] for i, col in enumerate(names)} for row in to_insert]
-        query = f'''
-                insert into {recordtype} ({cols})
-                select {cols}
-                from jsonb_to_recordset($1::jsonb) as x({types})
-                '''
-        await self.bot.pool.execute(query, transformed)
+        logger.info('loading known avatar hashes')
+        try:
+            async with self.bot.pool.acquire() as con:
+                async with con.transaction():
+                    async for r in con.cursor('select hash from avy_urls', prefetch=10000):
+                        self.bot.known_avatars.add(r['hash'])
+        except db_errors:
+            logger.exception('loading known avatar hashes failed')
+            return
+        self.bot.known_avatars.hydrated = True
+        logger.info(f'loaded {len(self.bot.known_avatars)} known avatar hashes')
 
     async def dl_avys(self):
+        """
+            Feeds avatars that are not archived yet from bot.avy_urls to the download workers.
+        """
         logger.info('started avatar downloading task')
-
-        async def url_to_bytes(hash, url):
-            if isinstance(url, tuple):
-                retries = url[1] - 1
-                url = url[0]
-            else:
-                retries = 5
-
-            try:
-                async with self.bot.session.get(str(url)) as r:
-                    if r.status == 200:
-                        await self.bot.avy_posting_queue.put((hash, BytesIO(await r.read())))
-                        return
-                    if r.status in {403, 404}:
-                        # Discord has forsaken us. Mostly likely invalid url.
-                        pass
-                    elif r.status == 415:
-                        # Discord is bad. retry with lower size.
-                        url = URL(str(url))
-                        new_size = int(url.query.get('size', 1024))//2
-                        if new_size > 128:
-                            # give up resizing it. Its too small to be worthwhile.
-                            new_url = url.with_query(size=str(new_size))
-                        else:
-                            # could not find a gif size that did not throw 415, changing format to png.
-                            new_url = url.with_path(url.path.replace('gif','png')).with_query(size=1024)
-                        self.bot.avy_urls[hash] = new_url
-                    else:
-                        # unsuccessful. Probably hit with a 5xx connection error. Put it back in for next round if there are retries left.
-                        if retries:
-                            self.bot.avy_urls[hash] = (url, retries)
-                    logger.info(f'downloading {url} failed with {r.status}')
-            except (asyncio.TimeoutError, aiohttp.ClientError):
-                logger.exception(f'downloading {url} failed.')
-                self.bot.avy_urls[hash] = url
+        query = '''
+            select hash
+            from avy_urls
+            where
+                hash = any($1::text[])
+        '''
+        chunk = dict()
         try:
             await self.bot.wait_until_ready()
             while True:
                 while len(self.bot.avy_urls) == 0:
                     await asyncio.sleep(2)
-                query = '''
-                    select hash
-                    from avy_urls
-                    where
-                        hash = any($1::text[])
-                '''
-                to_check = list(self.bot.avy_urls.keys())
-                batch_size = 50000
-                for i in range(0, len(to_check), batch_size):
-                    results = await self.bot.pool.fetch(query, to_check[i:i+batch_size])
-                    for r in results:
-                        # remove items in the avatar url dict that are already in the db
-                        self.bot.avy_urls.pop(r['hash'], None)
-
-                chunk = dict()
-                while len(self.bot.avy_urls) > 0 and len(chunk) < (50 - self.bot.avy_posting_queue.qsize()):
-                    # grabs enough avatars to fill the posting queue with 50 avatars if possible
+
+                while len(self.bot.avy_urls) > 0 and len(chunk) < 50:
                     avy, url = self.bot.avy_urls.popitem()
-                    chunk[avy] = url
-                if chunk:
-                    await asyncio.gather(*[url_to_bytes(avy, url) for avy, url in chunk.items()])
-                await asyncio.sleep(2)
+                    if avy not in self.bot.known_avatars:
+                        chunk[avy] = url
+                if chunk and not self.bot.known_avatars.hydrated:
+                    # the known hashes are still loading, so ask the db about this chunk
+                    for r in await self.bot.pool.fetch(query, list(chunk)):
+                        self.bot.known_avatars.add(r['hash'])
+                        chunk.pop(r['hash'], None)
+                while chunk:
+                    avy, url = chunk.popitem()
+                    await self.download_queue.put((avy, url))
         except asyncio.CancelledError:
             logger.warning('avatar downloading task canceled')
+            self.bot.avy_urls.update(chunk)
+            while not self.download_queue.empty():
+                avy, url = self.download_queue.get_nowait()
+                self.bot.avy_urls[avy] = url
+
+    async def download_worker(self):
+        avy = None
+        try:
+            while True:
+                avy, url = await self.download_queue.get()
+                data = await self.bot.downloader.fetch(url, self.bot.download_retries)
+                if data is None:
+                    self.retry_avatar(avy, url)
+                else:
+                    try:
+                        await self.bot.loop.run_in_executor(None, self.bot.avatar_store.put, avy, data.getvalue())
+                    except OSError:
+                        # the store is only a cache in front of the archive channel
+                        logger.exception(f'storing avatar {avy} failed')
+                    await self.bot.avy_posting_queue.put((avy, url, data))
+                avy = None
+        except asyncio.CancelledError:
+            if avy is not None:
+                self.bot.avy_urls[avy] = url
+
+    def retry_avatar(self, avy, url):
+        """
+            Queues a failed avatar for download again after a backoff that doubles with every failure.
+            After max_avatar_attempts it is given up on until one of its users is seen with it again.
+        """
+        attempts = self.avatar_attempts.get(avy, 0) + 1
+        if attempts >= max_avatar_attempts:
+            self.avatar_attempts.pop(avy, None)
+            # the last value cache would otherwise skip the avatar for as long as its users keep it
+            self.bot.last_values['avatars'].forget_value(avy)
+            logger.warning(f'giving up on avatar {avy} after {attempts} attempts')
+            return
+        self.avatar_attempts[avy] = attempts
+        delay = min(60 * 2 ** attempts, 3600)
+        logger.info(f'avatar {avy} failed {attempts} times, retrying in {delay}s')
+        self.bot.loop.call_later(delay, self.bot.avy_urls.setdefault, avy, url)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def downloads(self, ctx):
+        """Shows avatar download counters and backlog."""
+        stats = self.bot.downloader.stats
+        await ctx.send(
+            f'{stats["downloaded"]} downloaded ({stats["bytes"]/1_000_000:.1f}MB), '
+            f'{stats["retried"]} retries, {stats["failed"]} failed\n'
+            f'{len(self.bot.avy_urls)} waiting, {self.download_queue.qsize()} queued, '
+            f'{self.bot.avy_posting_queue.qsize()} waiting to be posted')
 
     async def batch_post_avatars(self):
         logger.info('started avatar posting task')
         try:
             await self.bot.wait_until_ready()
             chan = self.bot.get_guild(self.bot.avy_guild).get_channel(self.bot.avy_channel)
+            window = {}
             while True:
-                if self.bot.avy_posting_queue.qsize() == 0:
+                if len(window) == 0 and self.bot.avy_posting_queue.qsize() == 0:
                     await asyncio.sleep(2)
 
-                to_post = {}
-                post_size = 0
-                while len(to_post) < 10 and self.bot.avy_posting_queue.qsize() > 0:
-                    avy, file = await self.bot.avy_posting_queue.get()
-                    s = file.getbuffer().nbytes
-                    if post_size + s < 8000000:
-                        post_size += s
-                        to_post[avy] = discord.File(file, filename=f'{avy}.{"png" if not avy.startswith("a_") else "gif"}')
-                    elif s > 8000000:
-                        new_bytes = None
-                        if avy.startswith('a_'):
-                            new_bytes = await self.bot.loop.run_in_executor(None, images.extract_first_frame, file)
-                        else:
-                            new_bytes = await self.bot.loop.run_in_executor(None, images.resize_to_limit, file, 8000000)
-                        await self.bot.avy_posting_queue.put((avy, new_bytes))
+                # hold a few ready avatars so they can be packed into as few messages as possible
+                while len(window) < self.bot.avy_post_lookahead and self.bot.avy_posting_queue.qsize() > 0:
+                    avy, url, file = self.bot.avy_posting_queue.get_nowait()
+                    try:
+                        if file.getbuffer().nbytes >= 8000000 and avy.startswith('a_'):
+                            file = await self.bot.renderer.render(images.extract_first_frame, file)
+                        if file.getbuffer().nbytes >= 8000000:
+                            file = await self.bot.renderer.render(images.resize_to_limit, file, 8000000)
+                    except (asyncio.TimeoutError, BrokenProcessPool, OSError, ValueError):
+                        logger.exception(f'shrinking avatar {avy} failed')
+                        self.retry_avatar(avy, url)
                         continue
-                    else:
-                        await self.bot.avy_posting_queue.put((avy, file))
-                        break
-                if len(to_post) == 0:
+                    window[avy] = file
+                if len(window) == 0:
                     continue
 
+                bins = packing.first_fit_decreasing(((avy, file.getbuffer().nbytes) for avy, file in window.items()), 10, 8000000)
+                to_post = {avy : discord.File(window.pop(avy), filename=f'{avy}.{"png" if not avy.startswith("a_") else "gif"}') for avy in bins[0]}
+
                 backup = {k: BytesIO(v.fp.getbuffer()) for k, v in to_post.items()}
 
                 for tries in range(5):
@@ -286,6 +893,9 @@ class Pop(commands.Cog):
                             on conflict (hash) do nothing
                         '''
                         await self.bot.pool.execute(query, transformed)
+                        for row in transformed:
+                            self.bot.known_avatars.add(row['hash'])
+                            self.avatar_attempts.pop(row['hash'], None)
                         if len(backup) == 0:
                             break
                         logger.warning(f'{len(backup)} failed to upload. retrying')
@@ -310,84 +920,81 @@ class Pop(commands.Cog):
         await self.bot.wait_until_ready()
 
         utcnow = datetime.datetime.utcnow()
-        await self.bot.request_offline_members(*[guild for guild in self.bot.guilds if guild.large])
         await self.cog_log(True, utcnow - datetime.timedelta(microseconds=1))
-        self.add_bulk_members(list(self.bot.get_all_members()), utcnow)
+        self.bot.memberships.clear()
+        seen = set()
+        guilds = self.bot.guilds
+        for i, chunked in enumerate(asyncio.as_completed([self.chunk(guild) for guild in guilds]), 1):
+            guild = await chunked
+            count = await self.add_guild_members(guild, utcnow, seen)
+            logger.info(f'synced {guild} ({i}/{len(guilds)}): {count} members')
         self.bot.synced.set()
-        logger.info("synced!")
-
-    def add_bulk_members(self, members, utcnow):
-        for m in members:
-            self.bot.pending_updates['nicks'].append((m.id, m.guild.id, m.nick, utcnow))
-        logger.info(f'Added members in bulk: {len(set(members))}')
-        for m in set(members):
-            self.bot.pending_updates['names'].append((m.id, m.name, utcnow))
-            self.bot.pending_updates['avatars'].append((
-                                                    m.id,
-                                                    m.avatar if m.avatar else m.default_avatar.name,
-                                                    utcnow
-                                                  ))
-            self.bot.pending_updates['discrims'].append((m.id, m.discriminator, utcnow))
-            self.bot.pending_updates['statuses'].append((m.id, m.status.name, utcnow))
-            self.bot.avy_urls[m.avatar if m.avatar else m.default_avatar.name] = str(m.avatar_url_as(static_format='png'))
+        logger.info(f"synced! {len(seen)} users")
 
+    async def chunk(self, guild):
+        if guild.large and not guild.chunked:
+            await guild.chunk()
+        return guild
+
+    async def add_guild_members(self, guild, utcnow, seen):
+        """
+            Queues a guild's members a slice at a time, yielding to the event loop in between.
+            Records that are not per guild are only queued for users not already in `seen`.
+        """
+        members = guild.members
+        slice_size = 1000
+        for i in range(0, len(members), slice_size):
+            for m in members[i:i+slice_size]:
+                self.bot.memberships.add(m.id, guild.id)
+                self.queue_update('nicks', (m.id, guild.id, m.nick, utcnow))
+                if m.id not in seen:
+                    seen.add(m.id)
+                    self.add_user(m, utcnow)
+            await asyncio.sleep(0)
+        return len(members)
 
     def add_member(self, m, utcnow, full = True):
-        self.bot.pending_updates['nicks'].append((m.id, m.guild.id, m.nick, utcnow))
+        self.queue_update('nicks', (m.id, m.guild.id, m.nick, utcnow))
         if full:
-            self.bot.pending_updates['names'].append((m.id, m.name, utcnow))
-            self.bot.pending_updates['avatars'].append((
-                                                    m.id,
-                                                    m.avatar if m.avatar else m.default_avatar.name,
-                                                    utcnow
-                                                  ))
-            self.bot.pending_updates['discrims'].append((m.id, m.discriminator, utcnow))
-            self.bot.pending_updates['statuses'].append((m.id, m.status.name, utcnow))
-            self.bot.avy_urls[m.avatar if m.avatar else m.default_avatar.name] = str(m.avatar_url_as(static_format='png'))
+            self.add_user(m, utcnow)
+
+    def add_user(self, m, utcnow):
+        self.queue_update('names', (m.id, m.name, utcnow))
+        avatar = m.avatar if m.avatar else m.default_avatar.name
+        if self.queue_update('avatars', (m.id, avatar, utcnow)) and avatar not in self.bot.known_avatars:
+            self.bot.avy_urls[avatar] = str(m.avatar_url_as(static_format='png'))
+        self.queue_update('discrims', (m.id, m.discriminator, utcnow))
+        self.queue_update('statuses', (m.id, m.status.name, utcnow))
 
     def fill_updates(self, uid, sid, msg, utcnow, full = True):
         logger.debug(f'running fill_updates with {full}')
-        self.bot.pending_updates['nicks'].append((uid, sid, msg, utcnow))
+        self.queue_update('nicks', (uid, sid, msg, utcnow))
         if full:
-            self.bot.pending_removes.append((uid, utcnow))
+            self.queue_remove(uid, utcnow)
+            # the removal ends the current status interval, the next status seen has to be written
+            self.bot.last_values['statuses'].forget(uid)
 
-    async def batch_member_remove(self):
-        logger.info('started batch member remove task')
-        try:
-            await self.bot.wait_until_ready()
-            while True:
-                await asyncio.sleep(5)
-                await self.insert_member_removes()
-        except asyncio.CancelledError:
-            logger.warning('task for batch member remove was cancelled')
-            await self.insert_member_removes()
-        logger.info('exited batch member remove task')
-
-    async def insert_member_removes(self):
-        to_insert = self.bot.pending_removes[:]
-        if len(to_insert) == 0:
-            return
-        self.bot.pending_removes = []
-        transformed = [{'uid' : row[0], 'time' : row[1]} for row in to_insert]
+    async def insert_member_removes(self, con, records):
+        transformed = [{'uid' : row[0], 'time' : row[1]} for row in records]
         query = f'''
                 insert into member_removes (uid, time)
                 select uid, time
                 from jsonb_to_recordset($1::jsonb) as x(uid BIGINT, time TIMESTAMP WITHOUT TIME ZONE)
                 '''
-        await self.bot.pool.execute(query, transformed)
+        await con.execute(query, transformed)
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
         await self.bot.synced.wait()
         utcnow = datetime.datetime.utcnow()
-        do_full = sum(1 for g in self.bot.guilds if g.get_member(member.id)) == 1
+        do_full = self.bot.memberships.add(member.id, member.guild.id) == 1
         self.add_member(member, utcnow, do_full)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member):
         await self.bot.synced.wait()
         utcnow = datetime.datetime.utcnow()
-        do_full = sum(1 for g in self.bot.guilds if g.get_member(member.id)) == 0
+        do_full = self.bot.memberships.remove(member.id, member.guild.id) == 0
         self.fill_updates(member.id, member.guild.id, 'left_guild', utcnow, do_full) #untested stuff
     
 
@@ -398,16 +1005,13 @@ class Pop(commands.Cog):
         aid = after.id
 
         if before.name != after.name:
-            self.bot.pending_updates['names'].append((aid, after.name, utcnow))
+            self.queue_update('names', (aid, after.name, utcnow))
         if before.avatar != after.avatar:
-            self.bot.pending_updates['avatars'].append((
-                                                    aid,
-                                                    after.avatar if after.avatar else after.default_avatar.name,
-                                                    utcnow
-                                                  ))
-            self.bot.avy_urls[after.avatar if after.avatar else after.default_avatar.name] = str(after.avatar_url_as(static_format='png'))
+            avatar = after.avatar if after.avatar else after.default_avatar.name
+            if self.queue_update('avatars', (aid, avatar, utcnow)) and avatar not in self.bot.known_avatars:
+                self.bot.avy_urls[avatar] = str(after.avatar_url_as(static_format='png'))
         if before.discriminator != after.discriminator:
-            self.bot.pending_updates['discrims'].append((aid, after.discriminator, utcnow))
+            self.queue_update('discrims', (aid, after.discriminator, utcnow))
 
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
@@ -416,12 +1020,13 @@ class Pop(commands.Cog):
         aid = after.id
 
         if before.nick != after.nick:
-            self.bot.pending_updates['nicks'].append((aid, after.guild.id, after.nick, utcnow))
+            self.queue_update('nicks', (aid, after.guild.id, after.nick, utcnow))
+
+        # presence updates arrive once per mutual guild, only the lowest guild id records them
+        lowest = self.bot.memberships.lowest(aid)
 
-        lowest = discord.utils.find(lambda x: x.get_member(aid) is not None, sorted(self.bot.guilds, key=lambda x: x.id)) # stolen from luma I think
-        
-        if after.guild.id == lowest.id and before.status != after.status:
-            self.bot.pending_updates['statuses'].append((aid, after.status.name, utcnow))
+        if lowest in (None, after.guild.id) and before.status != after.status:
+            self.queue_update('statuses', (aid, after.status.name, utcnow))
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
@@ -431,29 +1036,39 @@ class Pop(commands.Cog):
         """
         await self.bot.synced.wait()
         utcnow = datetime.datetime.utcnow()
-        self.add_bulk_members(guild.members, utcnow)
-        logger.info(f'Added {guild.member_count} people to queues!')
+        count = await self.add_guild_members(guild, utcnow, set())
+        logger.info(f'Added {count} people to queues!')
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         """
             Figuring out which users the bot can still see is important.
-            Need to find a better way to figure out if the user is in any other mutual guilds.
+            The membership index says whether the user is in any other mutual guilds.
         """
         await self.bot.synced.wait()
         utcnow = datetime.datetime.utcnow()
         for member in guild.members:
-            if sum(1 for g in self.bot.guilds if g.get_member(member.id)) == 0:
-                self.fill_updates(member.id, member.guild.id, 'left_guild', utcnow, True)
-            else:
-                self.fill_updates(member.id, member.guild.id, 'left_guild', utcnow, False)
+            remaining = self.bot.memberships.remove(member.id, guild.id)
+            self.fill_updates(member.id, member.guild.id, 'left_guild', utcnow, remaining == 0)
 
 
 def setup(bot):
     if not hasattr(bot, 'pending_updates'):
-        bot.pending_updates = {recordtype : [] for recordtype in scheme.keys()}
+        bot.pending_updates = {recordtype : record_buffer(scheme[recordtype]) for recordtype in scheme.keys()}
+    if not hasattr(bot, 'last_values'):
+        bot.last_values = {recordtype : LastValueCache(bot.last_value_cache_size) for recordtype in scheme.keys()}
     if not hasattr(bot, 'pending_removes'):
-        bot.pending_removes = []
+        bot.pending_removes = record_buffer(removes_scheme)
+    if not hasattr(bot, 'journals'):
+        bot.journals = {name : Journal(os.path.join(bot.journal_dir, name)) for name in [*scheme.keys(), 'member_removes']}
+        # a flush seals the same number in every journal, and numbers are not reused across runs
+        start = max(int(time.time() * 1000), *(journal.next_seq for journal in bot.journals.values()))
+        for journal in bot.journals.values():
+            journal.start_at(start)
+    if not hasattr(bot, 'memberships'):
+        bot.memberships = MembershipIndex()
+    if not hasattr(bot, 'known_avatars'):
+        bot.known_avatars = AvatarHashSet()
     if not hasattr(bot, 'avy_urls'):
         bot.avy_urls = dict()
     if not hasattr(bot, 'avy_posting_queue'):
@@ -1,76 +1,221 @@
 import discord
 from discord.ext import commands
-import time
 import datetime
+import re
 from io import BytesIO
-from .utils import pretty
+from .utils import charts, pretty
+from .utils.export import GzipParts
+from .utils.timeline import HourGrid, Timeline, arrays
 import typing
-from math import cos, sin, radians, ceil
-from PIL import Image, ImageOps, ImageDraw, ImageFilter, ImageEnhance, ImageFont
 import logging
 
 logger = logging.getLogger(__name__)
 
-status = {'online':(67, 181, 129),
-          'idle':(250, 166, 26),
-          'dnd':(240, 71, 71),
-          'offline':(116, 127, 141)}
-status_names = set(status)
-discord_neutral = (188,188,188)
-
-query_base = '''
-with status_data as(
-    select
-        status,
-        first_seen_chopped as first_seen,
-        case when 
-            lag(first_seen_chopped) over (order by first_seen desc) is null then
-                now() at time zone 'utc'
-            else
-                lag(first_seen_chopped) over (order by first_seen desc)
-        end as last_seen
-    from (
-        select
-            distinct on (first_seen_chopped)
-            first_seen,
-            case when first_seen < (now() at time zone 'utc' - interval '30 days') then
-                (now() at time zone 'utc' - interval '30 days')
-                else first_seen end as first_seen_chopped,
-            status,
-            lag(status) over (order by first_seen desc) as status_last
-        from ( 
-            (select status, first_seen
-            from statuses
-            where uid=0
-            order by first_seen desc)
-            union
-            (select event::text::status as status, time as first_seen
-            from cog_log
-            order by first_seen desc)
-            union
-            (select 'left_guild' as status, time as first_seen
-            from member_removes
-            where uid=$1
-            order by first_seen desc)
-            union
-            (select status, first_seen
-            from statuses
-            where uid=$1
-            order by first_seen desc
-            limit 3000)
-        ) first3000
-        order by first_seen_chopped desc, first_seen desc
-    ) subtable
-    where
-        status is distinct from status_last
+# the latest row of each source before the window gives the status the window starts with
+transitions_query = '''
+    (select status, first_seen
+    from statuses
+    where uid=$1 and first_seen < $2
     order by first_seen desc
-)
+    limit 1)
+    union all
+    (select status, first_seen
+    from statuses
+    where uid=0 and first_seen < $2
+    order by first_seen desc
+    limit 1)
+    union all
+    (select event::text::status as status, time as first_seen
+    from cog_log
+    where time < $2
+    order by time desc
+    limit 1)
+    union all
+    select status, first_seen
+    from statuses
+    where uid in ($1, 0) and first_seen >= $2
+    union all
+    select event::text::status as status, time as first_seen
+    from cog_log
+    where time >= $2
+    union all
+    select 'left_guild' as status, time as first_seen
+    from member_removes
+    where uid=$1 and time >= $2
+'''
+
+hourly_query = '''
+    select hour, status, seconds, transitions
+    from status_hourly
+    where uid=$1 and hour >= $2
+'''
+
+latest_query = '''
+    (select status, first_seen
+    from statuses
+    where uid=$1
+    order by first_seen desc
+    limit 1)
+    union all
+    (select 'left_guild', time
+    from member_removes
+    where uid=$1
+    order by time desc
+    limit 1)
+    order by first_seen desc
+    limit 1
+'''
+
+# the events everyone shares, the latest before the window and all in it
+shared_query = '''
+    (select status::text, first_seen
+    from statuses
+    where uid=0 and first_seen < $1
+    order by first_seen desc
+    limit 1)
+    union all
+    (select event::text, time
+    from cog_log
+    where time < $1
+    order by time desc
+    limit 1)
+    union all
+    select status::text, first_seen
+    from statuses
+    where uid=0 and first_seen >= $1
+    union all
+    select event::text, time
+    from cog_log
+    where time >= $1
 '''
 
+current_query = '''
+    select status::text, since, last_offline
+    from status_current
+    where uid=$1
+'''
+
+# every history table a user can export, $1 is the uid, $2 and $3 the range of first_seen
+export_queries = {
+    'statuses' : (('status', 'first_seen'), '''
+        select status, first_seen
+        from statuses
+        where uid=$1 and first_seen >= $2 and first_seen < $3
+        union all
+        select status, first_seen
+        from statuses_archive
+        where uid=$1 and first_seen >= $2 and first_seen < $3
+    '''),
+    'names' : (('name', 'first_seen'), '''
+        select name, first_seen
+        from names
+        where uid=$1 and first_seen >= $2 and first_seen < $3
+    '''),
+    'avatars' : (('avatar', 'first_seen'), '''
+        select avatar, first_seen
+        from avatars
+        where uid=$1 and first_seen >= $2 and first_seen < $3
+    '''),
+    'discrims' : (('discrim', 'first_seen'), '''
+        select discrim, first_seen
+        from discrims
+        where uid=$1 and first_seen >= $2 and first_seen < $3
+    '''),
+    'nicks' : (('sid', 'nick', 'first_seen'), '''
+        select sid, nick, first_seen
+        from nicks
+        where uid=$1 and first_seen >= $2 and first_seen < $3
+    '''),
+    'member_removes' : (('time',), '''
+        select time
+        from member_removes
+        where uid=$1 and time >= $2 and time < $3
+    '''),
+}
+
 
 class Stats(commands.Cog):
+    UPLOAD_SIZE_LIMIT = 8_000_000
+
     def __init__(self, bot):
         self.bot = bot
+        self.phase_seconds = bot.metrics.histogram('koishi_command_phase_seconds', 'Time taken by each phase of the image commands.')
+        self.chart_lookups = bot.metrics.counter('koishi_chart_cache_lookups_total', 'Chart cache lookups by result.')
+        self.timeline_lookups = bot.metrics.counter('koishi_timeline_cache_lookups_total', 'Timeline cache lookups by result.')
+        self.hour_sources = bot.metrics.counter('koishi_hour_grids_total', 'Hourly grids by where they were computed from.')
+
+    def timed(self, ctx, phase):
+        return self.phase_seconds.time(command=ctx.command.name, phase=phase)
+
+    def chart_key(self, ctx, target, tz, *extra):
+        # charts are cached per hour, that is the finest detail any of them show
+        bucket = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        return (ctx.command.name, target.id, tz, bucket, *extra)
+
+    async def timeline(self, uid):
+        '''
+            The status changes of a user over the last 30 days, everything the stats commands are computed from.
+            They are fetched once and then kept up to date in the timeline cache while the user keeps asking.
+        '''
+        cache = self.bot.timelines
+        utcnow = datetime.datetime.utcnow()
+        start = utcnow - datetime.timedelta(days=cache.days)
+        changes = cache.get(uid)
+        self.timeline_lookups.inc(result='miss' if changes is None else 'hit')
+        if changes is None:
+            cache.reserve(uid)
+            try:
+                rows = await self.bot.pool.fetch(transitions_query, uid, start)
+            except BaseException:
+                cache.abandon(uid)
+                raise
+            # queued but not flushed yet
+            rows = [*rows, *(
+                {'status' : status, 'first_seen' : first_seen}
+                for u, status, first_seen in self.bot.pending_updates['statuses'] if u == uid
+            ), *(
+                {'status' : 'left_guild', 'first_seen' : first_seen}
+                for u, first_seen in self.bot.pending_removes if u == uid
+            )]
+            changes = cache.put(uid, *arrays(rows))
+        return Timeline(*changes, start, utcnow)
+
+    async def hours(self, uid):
+        '''
+            The time spent in each status per hour over the last 30 days. From the timeline cache if the user is in it,
+            otherwise from the hourly rollup, at most one row per hour and status, plus the status the user is in now
+            which is not rolled up yet. Both leave out the time the bot was not watching, cut by cog_log and uid 0 rows,
+            so they only differ by what is not flushed yet.
+        '''
+        if uid in self.bot.timelines:
+            self.hour_sources.inc(source='timeline')
+            return (await self.timeline(uid)).hours()
+        self.hour_sources.inc(source='rollup')
+        utcnow = datetime.datetime.utcnow()
+        start = utcnow - datetime.timedelta(days=self.bot.timelines.days)
+        async with self.bot.pool.acquire() as con:
+            rows = await con.fetch(hourly_query, uid, start.replace(minute=0, second=0, microsecond=0))
+            latest = await con.fetchrow(latest_query, uid)
+            shared = await con.fetch(shared_query, start)
+        return HourGrid.from_rollup(rows, latest, start, utcnow, shared)
+
+    async def cached_chart(self, key, render):
+        '''
+            Returns the chart for key from the chart cache, querying and rendering it with render() on a miss.
+        '''
+        cache = self.bot.chart_cache
+        data = cache.get(key)
+        self.chart_lookups.inc(result='miss' if data is None else 'hit')
+        if data is not None:
+            return BytesIO(data)
+        cache.begin(key)
+        try:
+            output = await render()
+        except BaseException:
+            cache.abandon(key)
+            raise
+        cache.put(key, output.getvalue())
+        return output
         
     @commands.command()
     async def toggle_purge(self, ctx):
@@ -111,45 +256,12 @@ class Stats(commands.Cog):
         msg = f'`{target.display_name} `has been **{target.status.name}** for as long as I can tell...'
         msg2 = ''
         status_info = offline_info = None
-        status_info = await self.bot.pool.fetchval('''
-            with lagged as(
-                select
-                    status,
-                    lag(status) over (order by first_seen asc) as status_lag,
-                    first_seen
-                from statuses
-                where (uid=$1 or uid=0) and
-                    first_seen > now() at time zone 'utc' - interval '30 days'
-            )
-            select distinct on (status)
-                first_seen
-            from lagged
-            where 
-                status != status_lag and
-                status = $2
-            order by status, first_seen desc
-        ''', target.id, target.status.name)
-        
-        if target.status.name != 'offline':
-            offline_info = await self.bot.pool.fetchval('''
-                with lagged as(
-                    select
-                        status,
-                        lag(status) over (order by first_seen asc) as status_lag,
-                        first_seen
-                    from statuses
-                    where (uid=$1 or uid=0) and
-                        first_seen > now() at time zone 'utc' - interval '30 days'
-                )
-                select
-                    first_seen
-                from lagged
-                where
-                    status != 'offline' and status_lag = 'offline'
-                order by first_seen desc
-                limit 1
-            ''', target.id)
-             
+        current = await self.bot.pool.fetchrow(current_query, target.id)
+        # a change still waiting to be flushed leaves it a few seconds behind
+        if current and current['status'] == target.status.name:
+            status_info = current['since']
+            offline_info = current['last_offline']
+
         if status_info:
             utcnow = datetime.datetime.utcnow()
             time = pretty.delta_to_str(status_info, utcnow)
@@ -160,7 +272,7 @@ class Stats(commands.Cog):
                     time = pretty.delta_to_str(offline_info, utcnow)
                     msg2 = f'Last **offline** {time} ago.'
                 else:
-                    msg2 = 'Has not been seen offline in the last 30 days as far as I can tell...'
+                    msg2 = 'Has not been seen offline as far as I can tell...'
             
         await ctx.send(f'{msg}\n{msg2}')
 
@@ -168,532 +280,160 @@ class Stats(commands.Cog):
     async def piestatus(self, ctx, *, target : discord.Member = None):
         '''Generates a pie chart displaying the ratios between the statuses the bot has seen the user use.'''
         target = target or ctx.author
+        avatar = target.avatar if target.avatar else target.default_avatar.name
+
+        async def render():
+            with self.timed(ctx, 'query'):
+                timeline = await self.timeline(target.id)
+            with self.timed(ctx, 'download'):
+                avydata = await self.bot.avatar_store.fetch(avatar, str(target.avatar_url_as(format='png')), self.bot.downloader)
+            statuses = {k: v for k, v in timeline.totals().items() if k in charts.status_names}
+            with self.timed(ctx, 'render'):
+                return await self.bot.renderer.render(charts.piestatus, avydata, statuses)
+
         async with ctx.channel.typing():
-            rows = await self.bot.pool.fetch(query_base + '''
-                select
-                    status,
-                    sum(
-                    extract(
-                    epoch from(
-                        last_seen - first_seen
-                    ))) as sum
-                from status_data
-                group by status
-                order by sum desc
-            ''', target.id)
-            async with self.bot.session.get(str(target.avatar_url_as(format='png'))) as r:
-                avydata = BytesIO(await r.read())
-            statuses = {row['status']: row['sum'] for row in rows if row['status'] in status_names}
-            data = await self.bot.loop.run_in_executor(None, self._piestatus, avydata, statuses)
-            await ctx.send(file=discord.File(data, filename=f'{target.display_name}_pie_status.png'))
-
-    def _piestatus(self, avydata, statuses):
-        total = sum(statuses.values())
-        stat_deg = {k:(v/total)*360 for k, v in statuses.items()}
-        angles = dict()
-        starting = -90
-        for k,v in stat_deg.items():
-            angles[k] = starting + v
-            starting += v
-        base = Image.new(mode='RGBA', size=(400, 300), color=(0, 0, 0, 0))
-        piebase = Image.new(mode='RGBA', size=(400, 300), color=(0, 0, 0, 0))
-        with Image.open(avydata).resize((200,200), resample=Image.BICUBIC).convert('RGBA') as avy:
-            with Image.open('piestatustest2.png').convert('L') as mask:
-                base.paste(avy, (50,50), avy)
-                draw = ImageDraw.Draw(piebase)
-                maskdraw = ImageDraw.Draw(mask)
-                starting = -90
-                for k, v in angles.items():
-                    if starting == v:
-                        continue
-                    else:
-                        draw.pieslice(((-5,-5),(305,305)),starting, v, fill=status[k])
-                        starting = v
-                if not 360 in stat_deg:
-                    mult = 1000
-                    offset = 150
-                    for k, v in angles.items():
-                        x = offset + ceil(offset * mult * cos(radians(v))) / mult
-                        y = offset + ceil(offset * mult * sin(radians(v))) / mult
-                        draw.line(((offset, offset), (x, y)), fill=(255,255,255,255), width=1)
-                del maskdraw
-                piebase.putalpha(mask)
-        font = ImageFont.truetype("arial.ttf", 15)
-        bx = 310
-        by = {'online':60, 'idle':110, 'dnd':160, 'offline':210}
-        base.paste(piebase, None, piebase)
-        draw = ImageDraw.Draw(base)
-        logger.debug(f'total statuses: {total}')
-        for k, v in statuses.items():
-            draw.rectangle(((bx, by[k]),(bx+30, by[k]+30)), fill=status[k], outline=(255,255,255,255))
-            draw.text((bx+40, by[k]+8), f'{(v/total)*100:.2f}%', fill=discord_neutral, font=font)
-            logger.debug(f'{(v/total)*100:.2f}%')
-        del draw
-        buffer = BytesIO()
-        base.save(buffer, 'png')
-        buffer.seek(0)
-        return buffer
+            data = await self.cached_chart(self.chart_key(ctx, target, 0, avatar), render)
+            with self.timed(ctx, 'send'):
+                await ctx.send(file=discord.File(data, filename=f'{target.display_name}_pie_status.png'))
 
     @commands.command()
     async def barstatus(self, ctx, *, target : discord.Member = None):
         '''Generates a bar graph of each status the bot has seen the user use.'''
         target = target or ctx.author
+        title = f'{target}\'s uptime in the past 30 days'
+
+        async def render():
+            with self.timed(ctx, 'query'):
+                timeline = await self.timeline(target.id)
+            statuses = {k: v for k, v in timeline.totals().items() if k in charts.status_names}
+            with self.timed(ctx, 'render'):
+                return await self.bot.renderer.render(charts.barstatus, title, statuses)
+
         async with ctx.channel.typing():
-            rows = await self.bot.pool.fetch(query_base + '''
-                select
-                    status,
-                    sum(
-                    extract(
-                    epoch from(
-                        last_seen - first_seen
-                    ))) as sum
-                from status_data
-                group by status
-                order by sum desc
-            ''', target.id)
-            statuses = {row['status']: row['sum'] for row in rows if row['status'] in status_names}
-            data = await self.bot.loop.run_in_executor(None, self._barstatus, f'{target}\'s uptime in the past 30 days', statuses)
-            await ctx.send(file=discord.File(data, filename=f'{target.display_name}_bar_status.png'))
-
-    def _barstatus(self, title, statuses):
-        highest = max(statuses.values())
-        highest_unit = self.get_significant(highest)
-        units = {stat:self.get_significant(value) for stat, value in statuses.items()}
-        heights = {stat:(value/highest)*250 for stat, value in statuses.items()}
-        box_size = (400,300)
-        rect_x_start = {k:64 + (84 * v) for k, v in {'online':0,'idle':1,'dnd':2,'offline':3}.items()}
-        rect_width = 70
-        rect_y_end = 275
-        labels = {'online':'Online', 'idle':'Idle', 'dnd':'DnD', 'offline':'Offline'}
-        base = Image.new(mode='RGBA', size=box_size, color=(0, 0, 0, 0))
-        with Image.open('barstatus_grid1.png') as grid:
-            font = ImageFont.truetype("arial.ttf", 12)
-            draw = ImageDraw.Draw(base)
-            draw.text((5, 5), highest_unit[1], fill=discord_neutral, font=font)
-            draw.text((52,2),title, fill=discord_neutral,font=font)
-            divs = 11
-            for i in range(divs):
-                draw.line(((50,25+((box_size[1]-50)/(divs-1))*i),(box_size[0],25+((box_size[1]-50)/(divs-1))*i)),fill=(*discord_neutral,128), width=1)
-                draw.text((5, 25+((box_size[1]-50)/(divs-1))*i-6), f'{highest_unit[0]-i*highest_unit[0]/(divs-1):.2f}', fill=discord_neutral, font=font)
-            for k, v in statuses.items():
-                draw.rectangle(((rect_x_start[k], rect_y_end - heights[k]),(rect_x_start[k]+rect_width, rect_y_end)), fill=status[k])
-                draw.text((rect_x_start[k], rect_y_end - heights[k] - 13), f'{units[k][0]} {units[k][1]}', fill=discord_neutral, font=font)
-                draw.text((rect_x_start[k], box_size[1] - 25), labels[k], fill=discord_neutral, font=font)
-            del draw
-            base.paste(grid, None, grid)
-        buffer = BytesIO()
-        base.save(buffer, 'png')
-        buffer.seek(0)
-        return buffer
-
-    def get_significant(self, stat):
-        word = ''
-        if stat >= 604800:
-            stat /= 604800
-            word = 'Week' 
-        elif stat >= 86400:
-            stat /= 86400
-            word = 'Day' 
-        elif stat >= 3600:
-            stat /= 3600
-            word = 'Hour' 
-        elif stat >= 60:
-            stat /= 60
-            word = 'Minute' 
-        else:
-            word = 'Second'
-        stat = float(f'{stat:.1f}')
-        if stat > 1 or stat == 0.0:
-            word += 's'
-        return stat, word
+            data = await self.cached_chart(self.chart_key(ctx, target, 0, title), render)
+            with self.timed(ctx, 'send'):
+                await ctx.send(file=discord.File(data, filename=f'{target.display_name}_bar_status.png'))
 
     @commands.command()
     async def histostatus(self, ctx, target : typing.Optional[discord.Member] = None , tz : int = 0):
         if tz > 12 or tz < -12:
             tz = 0
         target = target or ctx.author
-        query = query_base + '''
-            select
-                hour,
-                status,
-                extract(epoch from total) / extract(epoch from max(total) over ()) as percent
-            from (
-                select
-                    mod((extract(hour from s.hours)+$2+24)::integer, 24) as hour,
-                    s.status,
-                    sum(
-                    case 
-                        when date_trunc('hour', s.last_seen) = s.hours and
-                             date_trunc('hour', s.first_seen) = s.hours then
-                             s.last_seen - s.first_seen
-                        when date_trunc('hour', s.first_seen) = s.hours then 
-                             (s.hours + interval '1 hour') - s.first_seen
-                        when date_trunc('hour', s.last_seen) = s.hours then
-                             s.last_seen - s.hours
-                        else
-                            interval '1 hour'
-                    end
-                    ) as total
-                from (
-                    select
-                        status,
-                        first_seen,
-                        last_seen,
-                        generate_series(
-                            date_trunc('hour', first_seen),
-                            date_trunc('hour', case when last_seen is null then now() at time zone 'utc' else last_seen end),
-                            '1 hours'
-                        ) as hours
-                    from status_data
-                    where
-                        status in ('offline', 'idle', 'online', 'dnd')
-                ) as s
-                group by hour, s.status
-                order by hour asc
-            ) a
-            order by hour asc
-            '''
-        async with ctx.channel.typing():
-            utcnow = datetime.datetime.utcnow()
-            start_time = time.perf_counter()
-            data = await self.bot.pool.fetch(query, target.id, tz)
-            query_done_time = time.perf_counter()
+        title = f'{target.display_name}\'s resturant hours'
+        utcnow = datetime.datetime.utcnow()
+
+        async def render():
+            with self.timed(ctx, 'query'):
+                hours = await self.hours(target.id)
             current_hour = (utcnow.hour + tz) % 24
-            output = await self.bot.loop.run_in_executor(None, self._histostatus, f'{target.display_name}\'s resturant hours', data, current_hour, tz)
-            generated_time = time.perf_counter()
-            await ctx.send(file=discord.File(output, filename=f'{target.id} histostatus {utcnow.replace(microsecond=0,second=0,minute=0)}.png'))
-            finish_time = time.perf_counter()
-            msg = f'query done in **{(query_done_time - start_time)*1000:.2f}ms**'
-            msg += f'\nimage built in **{(generated_time - query_done_time)*1000:.2f}ms**'
-            msg += f'\nsent image in **{(finish_time - generated_time)*1000:.2f}ms**'
-            msg += f'\ntotal time **{(finish_time - start_time)*1000:.2f}ms**'
-            await ctx.send(f'*{msg}*')
-        
-    def _histostatus(self, title, data, current_hour, tz):
-        box_size = (400,300)
-        #base = Image.new(mode='RGBA', size=box_size, color=(0, 0, 0, 0))
-        with Image.open('histogram_template2.png') as base:
-            draw = ImageDraw.Draw(base)
-            x = 24
-            spacing = 16
-            draw_y0 = 0
-            draw_y1 = box_size[1]-30
-            trans_font = (*discord_neutral, 50)
-            font = ImageFont.truetype("arial.ttf", 12)
-            graphsize = 255
-            top_offset = 15
-            for i in range(25):
-                #Draw numbers
-                draw_x = x+spacing*i-8
-                draw.line(((draw_x,draw_y0),(draw_x,draw_y1)),fill=trans_font, width=1)
-                draw.line(((draw_x, draw_y1), (draw_x, draw_y1+top_offset)), fill=discord_neutral, width=1)
-                if i != 24:
-                    if i == current_hour:
-                        fontcolor = (0,255,0,255)
-                    else:
-                        fontcolor = discord_neutral
-                    draw.text((draw_x+1,draw_y1), f'{i:02}', fill=fontcolor, font=font)
-            draw.text((340,draw_y1+16), f'{"+" if tz >= 0 else ""}{tz}', fill=discord_neutral, font=font)
-            draw.text((2,2),title, fill=discord_neutral,font=font)
-
-            first = {'online':0,'idle':0,'dnd':0,'offline':0}
-            curr = {'online':0,'idle':0,'dnd':0,'offline':0}
-            prev = {'online':0,'idle':0,'dnd':0,'offline':0}
-            for d in data:
-                if d['hour'] == 0:
-                    first[d['status']] = d['percent']
-                if d['hour'] == 23:
-                    prev[d['status']] = d['percent']
-
-            hour = 0
-            for d in data:
-                if hour == d['hour']:
-                    curr[d['status']] = d['percent']
-                elif hour + 1 == d['hour']:
-                    for stat in prev.keys():
-                        x0 = x - spacing
-                        y0 = (graphsize - (prev[stat]*graphsize)) + top_offset
-                        x1 = x
-                        y1 = (graphsize - (curr[stat]*graphsize)) + top_offset
-                        draw.line(((x0,y0),(x1,y1)), fill=status[stat], width=1)
-                        draw.ellipse(((x1-1,y1-1),(x1+1,y1+1)), fill=status[stat])
-                    prev = curr
-                    curr = {'online':0,'idle':0,'dnd':0,'offline':0}
-                    curr[d['status']] = d['percent']
-                    hour += 1
-                    x += spacing
-            for k, v in prev.items():
-                x0 = x - spacing
-                y0 = (graphsize - v*graphsize) + top_offset
-                x1 = x
-                y1 = (graphsize - first[k]*graphsize) + top_offset
-                draw.line(((x0,y0),(x1,y1)), fill=status[k], width=1)
-
-            del draw
-            buffer = BytesIO()
-            base.save(buffer, 'png')
-        buffer.seek(0)
-        return buffer
+            with self.timed(ctx, 'render'):
+                return await self.bot.renderer.render(charts.histostatus, title, hours.histogram(tz), current_hour, tz)
 
+        async with ctx.channel.typing():
+            output = await self.cached_chart(self.chart_key(ctx, target, tz, title), render)
+            with self.timed(ctx, 'send'):
+                await ctx.send(file=discord.File(output, filename=f'{target.id} histostatus {utcnow.replace(microsecond=0,second=0,minute=0)}.png'))
+        
     @commands.command(aliases = ['hourlystatus'])
     async def calendarstatus(self, ctx, target : typing.Optional[discord.Member] = None , tz : int = 0):
         '''shows hourly presence data. Each row is a day. WIP'''
         if tz > 12 or tz < -12:
             tz = 0
-        tz_delta = datetime.timedelta(hours=tz)
         target = target or ctx.author
-        query = query_base + '''
-            select
-                s.hours as timestamp,
-                extract(day from s.hours) as day,
-                extract(hour from s.hours) as hour,
-                s.status,
-                sum(
-                    extract(EPOCH from 
-                        case 
-                            when date_trunc('hour', s.last_seen) = s.hours and
-                                 date_trunc('hour', s.first_seen) = s.hours then
-                                 s.last_seen - s.first_seen
-                            when date_trunc('hour', s.first_seen) = s.hours then 
-                                 (s.hours + interval '1 hour') - s.first_seen
-                            when date_trunc('hour', s.last_seen) = s.hours then
-                                 s.last_seen - s.hours
-                            else
-                                interval '1 hour'
-                        end
-                    )/3600
-                )as percent
-            from (
-                select
-                    status,
-                    first_seen + $2 as first_seen,
-                    last_seen + $2 as last_seen,
-                    generate_series(
-                        date_trunc('hour', first_seen + $2),
-                        date_trunc('hour', case when last_seen is null then now() at time zone 'utc' else last_seen end + $2),
-                        '1 hours'
-                    ) as hours
-                from status_data
-                where
-                    status in ('offline', 'idle', 'online', 'dnd')
-            ) as s
-            group by timestamp, status
-            order by timestamp, hour asc
-            '''
+
+        async def render():
+            with self.timed(ctx, 'query'):
+                hours = await self.hours(target.id)
+            with self.timed(ctx, 'render'):
+                return await self.bot.renderer.render(charts.calendarstatus, hours.day_shares(tz), tz)
+
         async with ctx.channel.typing():
-            data = await ctx.bot.pool.fetch(query, target.id, tz_delta)
-            output = await self.bot.loop.run_in_executor(None, self._calendarstatus, data, tz)
-            await ctx.send(file=discord.File(output, filename='test.png'))
-
-    def _calendarstatus(self, data, tz):
-        base = Image.new(mode='RGBA', size=(24, 31), color=(0, 0, 0, 0))
-        pix = base.load()
-        status_percent = {}
-        prev_timestamp = data[0]['timestamp']
-        prev_day = data[0]['day']
-        y = 0
-        for d in data:
-            if d['day'] != prev_day:
-                y += (d['timestamp'].date() - prev_timestamp.date()).days
-                prev_day = d['day']
-            if prev_timestamp != d['timestamp']:
-                x = d['hour']
-                pix[x,y] = self._calculate_color(status_percent, status)
-                prev_timestamp = d['timestamp']
-                status_percent = {}
-            status_percent[d['status']] = d['percent']
-
-        base = base.crop((0,0,24,y+1))
-        new_base = Image.new(mode='RGBA', size=(24, 31), color=(0, 0, 0, 0))
-        new_base.paste(base, box=(0,30-y),mask=base)
-        new_base = new_base.resize((400,new_base.size[1]),Image.NEAREST)
-        new_base = new_base.resize((400,300),Image.NEAREST)
-
-        buffer = BytesIO()
-        new_base.save(buffer, 'png')
-        buffer.seek(0)
-        return buffer
+            output = await self.cached_chart(self.chart_key(ctx, target, tz), render)
+            with self.timed(ctx, 'send'):
+                await ctx.send(file=discord.File(output, filename='test.png'))
 
     @commands.command(aliases = ['hourlystatuspie'])
     async def calendarstatuspie(self, ctx, target : typing.Optional[discord.Member] = None , tz : int = 0):
         '''shows hourly presence data. Spirals inward magically.'''
         if tz > 12 or tz < -12:
             tz = 0
-        tz_delta = datetime.timedelta(hours=tz)
         target = target or ctx.author
-        query = query_base + '''
-            select
-                s.hours as timestamp,
-                extract(day from s.hours) as day,
-                extract(hour from s.hours) as hour,
-                s.status,
-                sum(
-                    extract(EPOCH from 
-                        case 
-                            when date_trunc('hour', s.last_seen) = s.hours and
-                                 date_trunc('hour', s.first_seen) = s.hours then
-                                 s.last_seen - s.first_seen
-                            when date_trunc('hour', s.first_seen) = s.hours then 
-                                 (s.hours + interval '1 hour') - s.first_seen
-                            when date_trunc('hour', s.last_seen) = s.hours then
-                                 s.last_seen - s.hours
-                            else
-                                interval '1 hour'
-                        end
-                    )/3600
-                )as percent
-            from (
-                select
-                    status,
-                    first_seen + $2 as first_seen,
-                    last_seen + $2 as last_seen,
-                    generate_series(
-                        date_trunc('hour', first_seen + $2),
-                        date_trunc('hour', case when last_seen is null then now() at time zone 'utc' else last_seen end + $2),
-                        '1 hours'
-                    ) as hours
-                from status_data
-                where
-                    status in ('offline', 'idle', 'online', 'dnd')
-            ) as s
-            group by timestamp, status
-            order by timestamp, hour asc
-            '''
-        async with ctx.channel.typing():
-            data = await ctx.bot.pool.fetch(query, target.id, tz_delta)
-            parsed = self._parse_to_dict(data)
-            output = await self.bot.loop.run_in_executor(None, self._calendarstatuspie, parsed, tz)
-            await ctx.send(file=discord.File(output, filename='test.png'))
-
-    def _parse_to_dict(self, data):
-        output = {d : {h : (0,0,0,0) for h in range(24)} for d in range(31)}
-        status_percent = {}
-        prev_timestamp = data[0]['timestamp']
-        prev_day = data[0]['day']
-        y = 0
-        for d in data:
-            if d['day'] != prev_day:
-                y += (d['timestamp'].date() - prev_timestamp.date()).days
-                prev_day = d['day']
-            if prev_timestamp != d['timestamp']:
-                x = d['hour']
-                output[y][x] = self._calculate_color(status_percent, status)
-                prev_timestamp = d['timestamp']
-                status_percent = {}
-            status_percent[d['status']] = d['percent']
-        return output
-
-    def _calendarstatuspie(self, data, tz):
-        size = 1000
-        halfsize = size//2
-        offset = 30
-
-        base = Image.new(mode='RGBA', size=(size, size), color=(0, 0, 0, 0))
-        draw = ImageDraw.Draw(base)
-        i = 0
-        for day in range(30, -1, -1):
-            for hour in range((24*3)-1, -1, -1):
-                hour1 = hour / 3
-                hour2 = hour // 3
-                radius = int(((halfsize*(((day+offset)*24) + hour1)/((30+offset)*24))))
-                xy0 = halfsize - radius
-                xy1 = halfsize + radius
-
-                angle = (hour1/24)*360 - 90
-                angle2 = angle+(15/3)
-                draw.pieslice((xy0,xy0,xy1,xy1), angle, angle2, fill=data[day][hour2])
-                
-
 
-        buffer = BytesIO()
-        base.save(buffer, 'png')
-        buffer.seek(0)
-        return buffer
+        async def render():
+            with self.timed(ctx, 'query'):
+                hours = await self.hours(target.id)
+            with self.timed(ctx, 'render'):
+                return await self.bot.renderer.render(charts.calendarstatuspie, hours.day_shares(tz), tz)
 
+        async with ctx.channel.typing():
+            output = await self.cached_chart(self.chart_key(ctx, target, tz), render)
+            with self.timed(ctx, 'send'):
+                await ctx.send(file=discord.File(output, filename='test.png'))
 
     @commands.command()
     async def hourlyupdates(self, ctx, target : typing.Optional[discord.Member] = None , tz : int = 0):
         if tz > 12 or tz < -12:
             tz = 0
-        tz_delta = datetime.timedelta(hours=tz)
         target = target or ctx.author
-        query = query_base + '''
-            select
-                s.timestamp,
-                extract(day from s.timestamp) as day,
-                extract(hour from s.timestamp) as hour,
-                count(s.timestamp)
-            from (
-                select
-                    date_trunc('hour', first_seen + $2) as timestamp
-                from status_data
-                where
-                    status in ('offline', 'idle', 'online', 'dnd')
-            ) as s
-            group by timestamp
-            order by timestamp asc
-            '''
+
+        async def render():
+            with self.timed(ctx, 'query'):
+                hours = await self.hours(target.id)
+            with self.timed(ctx, 'render'):
+                return await self.bot.renderer.render(charts.hourlyupdates, hours.day_changes(tz), tz)
+
         async with ctx.channel.typing():
-            data = await ctx.bot.pool.fetch(query, target.id, tz_delta)
-            output = await self.bot.loop.run_in_executor(None, self._hourlyupdates, data, tz)
-            await ctx.send(file=discord.File(output, filename='test.png'))
-
-    def _hourlyupdates(self, data, tz):
-        base = Image.new(mode='RGBA', size=(24, 31), color=(0, 0, 0, 0))
-        pix = base.load()
-        prev_timestamp = data[0]['timestamp']
-        prev_day = data[0]['day']
-        y = 0
-        for d in data:
-            if d['day'] != prev_day:
-                y += (d['timestamp'].date() - prev_timestamp.date()).days
-                prev_timestamp = d['timestamp']
-                prev_day = d['day']
-            x = d['hour']
-            amount = min(1, d['count']/30)
-            overload = min(1, max(0, (d['count'] - 30)/30))
-            amount -= overload
-            percents = {'activity' : amount, 'overload' : overload}
-            colors = {'activity' : (67, 181, 129), 'overload' : (255,255,255)}
-            pix[x,y] = self._calculate_color(percents, colors)
-
-        base = base.crop((0,0,24,y+1))
-        new_base = Image.new(mode='RGBA', size=(24, 31), color=(0, 0, 0, 0))
-        new_base.paste(base, box=(0,30-y),mask=base)
-        new_base = new_base.resize((400,new_base.size[1]),Image.NEAREST)
-        new_base = new_base.resize((400,300),Image.NEAREST)
-
-        buffer = BytesIO()
-        new_base.save(buffer, 'png')
-        buffer.seek(0)
-        return buffer
-
-    def _calculate_color(self, percent, colors):
-        mult = sum(percent.values())
-        new_color = [int(sum((percent[key] / mult) * colors[key][i] for key, value in percent.items())) for i in range(3)]
-        alpha = ceil(mult * 255)
-        color_with_alpha = tuple([*new_color, alpha])
-        return color_with_alpha
+            output = await self.cached_chart(self.chart_key(ctx, target, tz), render)
+            with self.timed(ctx, 'send'):
+                await ctx.send(file=discord.File(output, filename='test.png'))
 
     @commands.command()
     @commands.cooldown(1,7200, commands.BucketType.user)
-    async def getstatusdata(self, ctx, limit : int = 0):
+    async def getstatusdata(self, ctx, *options):
+        '''
+            DMs you your history as gzipped CSV, newest first.
+            Options in any order: the tables to export (statuses by default, or all), a start and an end date as
+            YYYY-MM-DD, both included, and a maximum number of rows per table.
+        '''
+        tables, dates, limit = [], [], 0
+        for option in options:
+            if option == 'all':
+                tables.extend(export_queries)
+            elif option in export_queries:
+                tables.append(option)
+            elif option.isdigit():
+                limit = int(option)
+            elif re.fullmatch(r'\d{4}-\d{2}-\d{2}', option) and len(dates) < 2:
+                try:
+                    dates.append(datetime.datetime.strptime(option, '%Y-%m-%d'))
+                except ValueError:
+                    ctx.command.reset_cooldown(ctx)
+                    return await ctx.send(f'{option} is not a date.')
+            else:
+                ctx.command.reset_cooldown(ctx)
+                return await ctx.send(f'Unknown option {option}, tables are {", ".join(export_queries)} or all.')
+        tables = list(dict.fromkeys(tables)) or ['statuses']
+        start = dates[0] if dates else datetime.datetime.min
+        end = dates[1] + datetime.timedelta(days=1) if len(dates) > 1 else datetime.datetime.max
+
         async with ctx.channel.typing():
-            buf = BytesIO()
-            query = f'''
-                select
-                    status,
-                    first_seen
-                from statuses
-                where uid=$1
-                order by first_seen desc
-                {f'limit {limit}' if limit > 0 else ''}
-            '''
-            async with self.bot.pool.acquire() as con:
-                await con.copy_from_query(query, ctx.author.id, output=buf, format='csv')
-            buf.seek(0)
-            await ctx.send('Sent data to your DMs.')
-            await ctx.author.send(file=discord.File(buf, filename=f'{ctx.author.id}_statuses.csv'))
+            await ctx.send('Sending data to your DMs.')
+            for table in tables:
+                columns, query = export_queries[table]
+                query = f'''{query}
+                    order by {columns[-1]} desc
+                    {f'limit {limit}' if limit > 0 else ''}
+                '''
+                writer = GzipParts(f'{",".join(columns)}\n'.encode(), self.UPLOAD_SIZE_LIMIT)
+                try:
+                    async with self.bot.pool.acquire() as con:
+                        await con.copy_from_query(query, ctx.author.id, start, end, output=writer.write, format='csv')
+                    parts = await writer.close()
+                    for i, part in enumerate(parts, 1):
+                        suffix = f'_{i}' if len(parts) > 1 else ''
+                        await ctx.author.send(file=discord.File(part, filename=f'{ctx.author.id}_{table}{suffix}.csv.gz'))
+                finally:
+                    writer.discard()
 
 
 def setup(bot):
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from io import BytesIO
+
+_valid_key = re.compile(r'[A-Za-z0-9_]+')
+
+class AvatarStore:
+    '''
+        Avatar images on local disk, keyed by avatar hash and sharded into directories by its last characters.
+        Holds at most max_bytes, evicting the least recently used files first. Files are written atomically.
+        `get` and `put` do blocking file io and are safe to run in an executor.
+    '''
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        found = []
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                full = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    # left over from an interrupted write
+                    os.remove(full)
+                    continue
+                st = os.stat(full)
+                found.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(found):
+            self._index[name] = size
+            self.size += size
+        self._remove(self._evict())
+
+    def __len__(self):
+        return len(self._index)
+
+    def _path(self, key):
+        return os.path.join(self.path, key[-2:], key[-4:-2], key)
+
+    def _evict(self):
+        victims = []
+        while self.size > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self.size -= size
+            victims.append(key)
+        return victims
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(self._path(key), 'rb') as f:
+                return BytesIO(f.read())
+        except FileNotFoundError:
+            with self._lock:
+                self.size -= self._index.pop(key, 0)
+            return None
+
+    def put(self, key, data):
+        if not _valid_key.fullmatch(key) or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self.size -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self.size += len(data)
+            victims = self._evict()
+        self._remove(victims)
+
+    async def fetch(self, key, url, downloader):
+        '''
+            Reads an avatar from the store, downloading and storing it on a miss.
+            Returns None if it is not stored and could not be downloaded.
+        '''
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, self.get, key)
+        if data is None and url:
+            data = await downloader.fetch(url)
+            if data is not None:
+                await loop.run_in_executor(None, self.put, key, data.getvalue())
+        return data
@@ -0,0 +1,145 @@
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+class LastValueCache:
+    '''
+        Remembers the last value queued for each key so that records repeating it can be dropped.
+        Bounded to maxsize keys, least recently used keys are evicted first.
+        Keys that were not in the cache are kept in `misses` until the caller checks them against the db.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.misses = set()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def changed(self, key, value):
+        old = self._data.get(key, _missing)
+        if old is _missing:
+            self.misses.add(key)
+        elif old == value:
+            self._data.move_to_end(key)
+            return False
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return True
+
+    def forget(self, key):
+        self._data.pop(key, None)
+        self.misses.discard(key)
+
+    def forget_value(self, value):
+        '''Forgets every key whose last value is value, so the next record with it is queued again.'''
+        for key in [key for key, v in self._data.items() if v == value]:
+            del self._data[key]
+
+    def take_misses(self):
+        misses = self.misses
+        self.misses = set()
+        return misses
+
+    def clear(self):
+        self._data.clear()
+        self.misses.clear()
+
+class AvatarHashSet:
+    '''
+        Set of avatar hashes, stored as the raw bytes of the hex digest rather than the string.
+        `hydrated` is set once every hash already in the db has been added.
+    '''
+    def __init__(self):
+        self.hydrated = False
+        self._hashes = set()
+
+    @staticmethod
+    def _pack(avatar):
+        animated = avatar.startswith('a_')
+        try:
+            raw = bytes.fromhex(avatar[2:] if animated else avatar)
+        except ValueError:
+            # default avatars are named rather than hashed
+            return avatar
+        return b'a' + raw if animated else raw
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, avatar):
+        return self._pack(avatar) in self._hashes
+
+    def add(self, avatar):
+        self._hashes.add(self._pack(avatar))
+
+class ChartCache:
+    '''
+        Rendered charts as png bytes, keyed by (command, uid, tz, time bucket, ...).
+        Bounded to maxsize charts, least recently used first out, and each expires ttl seconds after it was rendered.
+        `invalidate` drops every chart of a user. A render that was in flight when its user was invalidated is not stored,
+        so call `begin` before querying and `put` after rendering, or `abandon` if it failed. uid 0 marks rows that apply to everyone.
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._keys = {}
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def _drop(self, key):
+        self._data.pop(key, None)
+        keys = self._keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[1]]
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires < time.monotonic():
+            self._drop(key)
+            return None
+        self._data.move_to_end(key)
+        return data
+
+    def begin(self, key):
+        self._inflight[key] = True
+
+    def abandon(self, key):
+        self._inflight.pop(key, None)
+
+    def put(self, key, data):
+        if not self._inflight.pop(key, False):
+            return
+        self._drop(key)
+        self._data[key] = (time.monotonic() + self.ttl, data)
+        self._keys.setdefault(key[1], set()).add(key)
+        if len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+
+    def invalidate(self, uids):
+        if 0 in uids:
+            self.clear()
+            return
+        for uid in uids:
+            for key in self._keys.pop(uid, ()):
+                self._data.pop(key, None)
+        for key in self._inflight:
+            if key[1] in uids:
+                self._inflight[key] = False
+
+    def clear(self):
+        self._data.clear()
+        self._keys.clear()
+        for key in self._inflight:
+            self._inflight[key] = False
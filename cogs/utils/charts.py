@@ -0,0 +1,303 @@
+import logging
+from io import BytesIO
+from collections import OrderedDict
+from math import cos, sin, radians, ceil
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from .timeline import charted
+
+logger = logging.getLogger(__name__)
+
+status = {'online':(67, 181, 129),
+          'idle':(250, 166, 26),
+          'dnd':(240, 71, 71),
+          'offline':(116, 127, 141)}
+status_names = set(status)
+discord_neutral = (188,188,188)
+
+class Assets:
+    '''
+        Fonts, decoded templates and pre-drawn static chart layers, loaded once per process.
+        Images are handed out as copies so renderers can draw on them.
+        At most max_layers layers are kept, least recently used first out.
+    '''
+    def __init__(self, max_layers=32):
+        self.max_layers = max_layers
+        self._fonts = {}
+        self._templates = {}
+        self._layers = OrderedDict()
+
+    def font(self, size):
+        if size not in self._fonts:
+            self._fonts[size] = ImageFont.truetype("arial.ttf", size)
+        return self._fonts[size]
+
+    def template(self, name, mode=None):
+        if (name, mode) not in self._templates:
+            with Image.open(name) as im:
+                self._templates[name, mode] = im.convert(mode) if mode else im.copy()
+        return self._templates[name, mode].copy()
+
+    def layer(self, build, *key):
+        '''Returns a copy of the layer drawn by build(*key), drawing it only the first time.'''
+        key = (build.__name__, *key)
+        if key in self._layers:
+            self._layers.move_to_end(key)
+        else:
+            self._layers[key] = build(*key[1:])
+            if len(self._layers) > self.max_layers:
+                self._layers.popitem(last=False)
+        return self._layers[key].copy()
+
+assets = Assets()
+
+def warm():
+    '''Loads the fonts, templates and the most used layers up front, run once in each render worker.'''
+    for size in (12, 15):
+        assets.font(size)
+    assets.template('piestatustest2.png', 'L')
+    assets.template('barstatus_grid1.png')
+    assets.template('histogram_template2.png')
+    assets.layer(_bar_grid)
+
+def _bar_grid():
+    box_size = (400,300)
+    base = Image.new(mode='RGBA', size=box_size, color=(0, 0, 0, 0))
+    draw = ImageDraw.Draw(base)
+    divs = 11
+    for i in range(divs):
+        draw.line(((50,25+((box_size[1]-50)/(divs-1))*i),(box_size[0],25+((box_size[1]-50)/(divs-1))*i)),fill=(*discord_neutral,128), width=1)
+    return base
+
+def _histogram_axes(current_hour, tz):
+    box_size = (400,300)
+    base = assets.template('histogram_template2.png')
+    draw = ImageDraw.Draw(base)
+    x = 24
+    spacing = 16
+    draw_y0 = 0
+    draw_y1 = box_size[1]-30
+    trans_font = (*discord_neutral, 50)
+    font = assets.font(12)
+    top_offset = 15
+    for i in range(25):
+        #Draw numbers
+        draw_x = x+spacing*i-8
+        draw.line(((draw_x,draw_y0),(draw_x,draw_y1)),fill=trans_font, width=1)
+        draw.line(((draw_x, draw_y1), (draw_x, draw_y1+top_offset)), fill=discord_neutral, width=1)
+        if i != 24:
+            if i == current_hour:
+                fontcolor = (0,255,0,255)
+            else:
+                fontcolor = discord_neutral
+            draw.text((draw_x+1,draw_y1), f'{i:02}', fill=fontcolor, font=font)
+    draw.text((340,draw_y1+16), f'{"+" if tz >= 0 else ""}{tz}', fill=discord_neutral, font=font)
+    del draw
+    return base
+
+def piestatus(avydata, statuses):
+    total = sum(statuses.values())
+    stat_deg = {k:(v/total)*360 for k, v in statuses.items()}
+    angles = dict()
+    starting = -90
+    for k,v in stat_deg.items():
+        angles[k] = starting + v
+        starting += v
+    base = Image.new(mode='RGBA', size=(400, 300), color=(0, 0, 0, 0))
+    piebase = Image.new(mode='RGBA', size=(400, 300), color=(0, 0, 0, 0))
+    with Image.open(avydata).resize((200,200), resample=Image.BICUBIC).convert('RGBA') as avy:
+        with assets.template('piestatustest2.png', 'L') as mask:
+            base.paste(avy, (50,50), avy)
+            draw = ImageDraw.Draw(piebase)
+            maskdraw = ImageDraw.Draw(mask)
+            starting = -90
+            for k, v in angles.items():
+                if starting == v:
+                    continue
+                else:
+                    draw.pieslice(((-5,-5),(305,305)),starting, v, fill=status[k])
+                    starting = v
+            if not 360 in stat_deg:
+                mult = 1000
+                offset = 150
+                for k, v in angles.items():
+                    x = offset + ceil(offset * mult * cos(radians(v))) / mult
+                    y = offset + ceil(offset * mult * sin(radians(v))) / mult
+                    draw.line(((offset, offset), (x, y)), fill=(255,255,255,255), width=1)
+            del maskdraw
+            piebase.putalpha(mask)
+    font = assets.font(15)
+    bx = 310
+    by = {'online':60, 'idle':110, 'dnd':160, 'offline':210}
+    base.paste(piebase, None, piebase)
+    draw = ImageDraw.Draw(base)
+    logger.debug(f'total statuses: {total}')
+    for k, v in statuses.items():
+        draw.rectangle(((bx, by[k]),(bx+30, by[k]+30)), fill=status[k], outline=(255,255,255,255))
+        draw.text((bx+40, by[k]+8), f'{(v/total)*100:.2f}%', fill=discord_neutral, font=font)
+        logger.debug(f'{(v/total)*100:.2f}%')
+    del draw
+    buffer = BytesIO()
+    base.save(buffer, 'png')
+    buffer.seek(0)
+    return buffer
+
+def barstatus(title, statuses):
+    highest = max(statuses.values())
+    highest_unit = get_significant(highest)
+    units = {stat:get_significant(value) for stat, value in statuses.items()}
+    heights = {stat:(value/highest)*250 for stat, value in statuses.items()}
+    box_size = (400,300)
+    rect_x_start = {k:64 + (84 * v) for k, v in {'online':0,'idle':1,'dnd':2,'offline':3}.items()}
+    rect_width = 70
+    rect_y_end = 275
+    labels = {'online':'Online', 'idle':'Idle', 'dnd':'DnD', 'offline':'Offline'}
+    base = assets.layer(_bar_grid)
+    with assets.template('barstatus_grid1.png') as grid:
+        font = assets.font(12)
+        draw = ImageDraw.Draw(base)
+        draw.text((5, 5), highest_unit[1], fill=discord_neutral, font=font)
+        draw.text((52,2),title, fill=discord_neutral,font=font)
+        divs = 11
+        for i in range(divs):
+            draw.text((5, 25+((box_size[1]-50)/(divs-1))*i-6), f'{highest_unit[0]-i*highest_unit[0]/(divs-1):.2f}', fill=discord_neutral, font=font)
+        for k, v in statuses.items():
+            draw.rectangle(((rect_x_start[k], rect_y_end - heights[k]),(rect_x_start[k]+rect_width, rect_y_end)), fill=status[k])
+            draw.text((rect_x_start[k], rect_y_end - heights[k] - 13), f'{units[k][0]} {units[k][1]}', fill=discord_neutral, font=font)
+            draw.text((rect_x_start[k], box_size[1] - 25), labels[k], fill=discord_neutral, font=font)
+        del draw
+        base.paste(grid, None, grid)
+    buffer = BytesIO()
+    base.save(buffer, 'png')
+    buffer.seek(0)
+    return buffer
+
+def get_significant(stat):
+    word = ''
+    if stat >= 604800:
+        stat /= 604800
+        word = 'Week' 
+    elif stat >= 86400:
+        stat /= 86400
+        word = 'Day' 
+    elif stat >= 3600:
+        stat /= 3600
+        word = 'Hour' 
+    elif stat >= 60:
+        stat /= 60
+        word = 'Minute' 
+    else:
+        word = 'Second'
+    stat = float(f'{stat:.1f}')
+    if stat > 1 or stat == 0.0:
+        word += 's'
+    return stat, word
+
+def histostatus(title, data, current_hour, tz):
+    # grid, hour labels and timezone are the same for every render with this hour and tz
+    with assets.layer(_histogram_axes, current_hour, tz) as base:
+        draw = ImageDraw.Draw(base)
+        x = 24
+        spacing = 16
+        font = assets.font(12)
+        graphsize = 255
+        top_offset = 15
+        draw.text((2,2),title, fill=discord_neutral,font=font)
+
+        first = {'online':0,'idle':0,'dnd':0,'offline':0}
+        curr = {'online':0,'idle':0,'dnd':0,'offline':0}
+        prev = {'online':0,'idle':0,'dnd':0,'offline':0}
+        for d in data:
+            if d['hour'] == 0:
+                first[d['status']] = d['percent']
+            if d['hour'] == 23:
+                prev[d['status']] = d['percent']
+
+        hour = 0
+        for d in data:
+            if hour == d['hour']:
+                curr[d['status']] = d['percent']
+            elif hour + 1 == d['hour']:
+                for stat in prev.keys():
+                    x0 = x - spacing
+                    y0 = (graphsize - (prev[stat]*graphsize)) + top_offset
+                    x1 = x
+                    y1 = (graphsize - (curr[stat]*graphsize)) + top_offset
+                    draw.line(((x0,y0),(x1,y1)), fill=status[stat], width=1)
+                    draw.ellipse(((x1-1,y1-1),(x1+1,y1+1)), fill=status[stat])
+                prev = curr
+                curr = {'online':0,'idle':0,'dnd':0,'offline':0}
+                curr[d['status']] = d['percent']
+                hour += 1
+                x += spacing
+        for k, v in prev.items():
+            x0 = x - spacing
+            y0 = (graphsize - v*graphsize) + top_offset
+            x1 = x
+            y1 = (graphsize - first[k]*graphsize) + top_offset
+            draw.line(((x0,y0),(x1,y1)), fill=status[k], width=1)
+
+        del draw
+        buffer = BytesIO()
+        base.save(buffer, 'png')
+    buffer.seek(0)
+    return buffer
+
+def mix_colors(shares, colors):
+    '''
+        Mixes colors, an (n, 3) array, by shares (..., n) of a whole into RGBA pixels,
+        the alpha being how much of the whole the shares fill.
+    '''
+    total = shares.sum(axis=-1, keepdims=True)
+    rgb = np.divide(shares @ colors, total, out=np.zeros((*shares.shape[:-1], 3)), where=total > 0)
+    alpha = np.ceil(np.minimum(total, 1) * 255)
+    return np.concatenate((rgb, alpha), axis=-1).astype(np.uint8)
+
+def _grid_png(pixels):
+    im = Image.fromarray(pixels, 'RGBA').resize((400,300), Image.NEAREST)
+    buffer = BytesIO()
+    im.save(buffer, 'png')
+    buffer.seek(0)
+    return buffer
+
+def calendarstatus(shares, tz):
+    '''shares is a (days, 24, statuses) array of the share of each hour spent in each charted status, the last day being today.'''
+    return _grid_png(mix_colors(shares, np.array([status[name] for name in charted])))
+
+def calendarstatuspie(shares, tz):
+    data = mix_colors(shares, np.array([status[name] for name in charted])).tolist()
+    size = 1000
+    halfsize = size//2
+    offset = 30
+
+    base = Image.new(mode='RGBA', size=(size, size), color=(0, 0, 0, 0))
+    draw = ImageDraw.Draw(base)
+    i = 0
+    for day in range(30, -1, -1):
+        for hour in range((24*3)-1, -1, -1):
+            hour1 = hour / 3
+            hour2 = hour // 3
+            radius = int(((halfsize*(((day+offset)*24) + hour1)/((30+offset)*24))))
+            xy0 = halfsize - radius
+            xy1 = halfsize + radius
+
+            angle = (hour1/24)*360 - 90
+            angle2 = angle+(15/3)
+            draw.pieslice((xy0,xy0,xy1,xy1), angle, angle2, fill=tuple(data[day][hour2]))
+            
+
+
+    buffer = BytesIO()
+    base.save(buffer, 'png')
+    buffer.seek(0)
+    return buffer
+
+def hourlyupdates(counts, tz):
+    '''counts is a (days, 24) array of the number of status changes in each hour, the last day being today.'''
+    # green up to 30 changes an hour, then fading to white at 60
+    overload = np.clip((counts - 30) / 30, 0, 1)
+    activity = np.minimum(1, counts / 30) - overload
+    shares = np.stack((activity, overload), axis=-1)
+    return _grid_png(mix_colors(shares, np.array([(67, 181, 129), (255, 255, 255)])))
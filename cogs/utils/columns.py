@@ -0,0 +1,116 @@
+import datetime
+from array import array
+
+EPOCH = datetime.datetime(1970, 1, 1)
+_null = -2**63
+
+class _IntColumn:
+    def __init__(self):
+        self.values = array('q')
+
+    def encode(self, value):
+        return value
+
+    def store(self, value):
+        self.values.append(value)
+
+    def __iter__(self):
+        return iter(self.values)
+
+class _TimeColumn:
+    '''Naive utc datetimes stored as microseconds since the epoch.'''
+    def __init__(self):
+        self.values = array('q')
+
+    def encode(self, value):
+        return _null if value is None else (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+    def store(self, value):
+        self.values.append(value)
+
+    def __iter__(self):
+        for v in self.values:
+            yield None if v == _null else EPOCH + datetime.timedelta(microseconds=v)
+
+class _EnumColumn:
+    '''Strings from a small fixed set stored as one byte codes.'''
+    def __init__(self, names):
+        self.names = names
+        self.codes = {name : i for i, name in enumerate(names)}
+        self.values = array('B')
+
+    def encode(self, value):
+        return self.codes[value]
+
+    def store(self, value):
+        self.values.append(value)
+
+    def __iter__(self):
+        names = self.names
+        for v in self.values:
+            yield names[v]
+
+class _TextColumn:
+    '''
+        Strings stored back to back as utf-8 with the end offset of each one.
+        A null is stored as the bitwise not of the current end offset.
+    '''
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('q')
+
+    def encode(self, value):
+        return None if value is None else value.encode('utf-8', 'surrogatepass')
+
+    def store(self, value):
+        if value is None:
+            self.ends.append(~len(self.data))
+        else:
+            self.data += value
+            self.ends.append(len(self.data))
+
+    def __iter__(self):
+        data = self.data
+        start = 0
+        for end in self.ends:
+            if end < 0:
+                yield None
+                start = ~end
+            else:
+                yield data[start:end].decode('utf-8', 'surrogatepass')
+                start = end
+
+class RecordBuffer:
+    '''
+        Column-oriented buffer of queued records, a compact stand-in for a list of tuples.
+        `columns` maps column names to their sql types, `enums` maps text columns to their allowed values.
+        Iterating yields the records as tuples one at a time, so it can be passed straight to copy_records_to_table.
+    '''
+    def __init__(self, columns, records=(), enums=None):
+        enums = enums or {}
+        self._columns = []
+        for name, sqltype in columns.items():
+            if name in enums:
+                self._columns.append(_EnumColumn(enums[name]))
+            elif sqltype == 'BIGINT':
+                self._columns.append(_IntColumn())
+            elif sqltype.startswith('TIMESTAMP'):
+                self._columns.append(_TimeColumn())
+            else:
+                self._columns.append(_TextColumn())
+        self._len = 0
+        for record in records:
+            self.append(record)
+
+    def append(self, record):
+        # encode every value first so a bad one leaves the columns untouched
+        encoded = [column.encode(value) for column, value in zip(self._columns, record)]
+        for column, value in zip(self._columns, encoded):
+            column.store(value)
+        self._len += 1
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return zip(*self._columns)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import random
+from collections import Counter
+from io import BytesIO
+
+import aiohttp
+from yarl import URL
+
+logger = logging.getLogger(__name__)
+
+class Downloader:
+    '''
+        HTTP client for avatars with its own bounded, keep-alive connection pool and per-request timeout.
+        `stats` counts downloads, bytes, retries and failures.
+    '''
+    def __init__(self, connections_per_host, timeout):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=connections_per_host, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+        self.stats = Counter()
+
+    async def get(self, url):
+        async with self.session.get(str(url)) as r:
+            if r.status != 200:
+                return r.status, None
+            data = await r.read()
+        self.stats['downloaded'] += 1
+        self.stats['bytes'] += len(data)
+        return 200, data
+
+    async def fetch(self, url, retries=1):
+        '''
+            Downloads url into a BytesIO, retrying errors with jittered exponential backoff.
+            Returns None if it could not be downloaded.
+        '''
+        for attempt in range(retries + 1):
+            if attempt:
+                self.stats['retried'] += 1
+                await asyncio.sleep(min(60, 2 ** attempt) * random.uniform(0.5, 1.5))
+            try:
+                status, data = await self.get(url)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                logger.exception(f'downloading {url} failed.')
+                continue
+            if status == 200:
+                return BytesIO(data)
+            logger.info(f'downloading {url} failed with {status}')
+            if status in {403, 404}:
+                # Discord has forsaken us. Mostly likely invalid url.
+                break
+            elif status == 415:
+                # Discord is bad. retry with lower size.
+                url = URL(str(url))
+                new_size = int(url.query.get('size', 1024))//2
+                if new_size > 128:
+                    url = url.with_query(size=str(new_size))
+                else:
+                    # could not find a gif size that did not throw 415, changing format to png.
+                    url = url.with_path(url.path.replace('gif','png')).with_query(size=1024)
+        self.stats['failed'] += 1
+        return None
+
+    async def close(self):
+        await self.session.close()
@@ -0,0 +1,87 @@
+import asyncio
+import gzip
+import tempfile
+
+
+class GzipParts:
+    '''
+        Gzips CSV written to it in chunks into temporary files of at most about part_size bytes each,
+        so an export of any size never has to be held in memory or uploaded in one go.
+        Parts are only cut between rows and each one starts with the header, so every part is a CSV of its own.
+        Quotes are counted across the whole stream to tell a newline that ends a row from one inside a quoted value.
+        Compressing and writing run in the default executor, one chunk at a time as each write is awaited.
+    '''
+    # gzip holds back some output until it has enough input, the size of a part is only checked after that shows up
+    SLACK = 256 * 1024
+
+    def __init__(self, header, part_size, compresslevel=6):
+        self.header = header
+        self.limit = part_size - self.SLACK
+        self.compresslevel = compresslevel
+        self.parts = []
+        self._quotes = 0
+        self._raw = None
+        self._gz = None
+        self._start()
+
+    def _start(self):
+        self._raw = tempfile.TemporaryFile()
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=self.compresslevel)
+        self._gz.write(self.header)
+        self._empty = True
+
+    def _finish(self):
+        self._gz.close()
+        self._raw.seek(0)
+        self.parts.append(self._raw)
+
+    def _row_end(self, data):
+        '''The index just past the first newline in data that is outside of quotes, or None.'''
+        quotes = self._quotes
+        start = 0
+        while True:
+            newline = data.find(b'\n', start)
+            if newline == -1:
+                return None
+            quotes += data.count(b'"', start, newline)
+            if quotes % 2 == 0:
+                return newline + 1
+            start = newline + 1
+
+    def _write(self, data):
+        self._gz.write(data)
+        self._quotes += data.count(b'"')
+        self._empty = False
+
+    def _put(self, data):
+        if self._empty or self._raw.tell() < self.limit:
+            self._write(data)
+            return
+        end = self._row_end(data)
+        if end is None:
+            self._write(data)
+            return
+        self._write(data[:end])
+        self._finish()
+        self._start()
+        if end < len(data):
+            self._write(data[end:])
+
+    async def write(self, data):
+        await asyncio.get_running_loop().run_in_executor(None, self._put, data)
+
+    def _close(self):
+        self._finish()
+        if self._empty and len(self.parts) > 1:
+            self.parts.pop().close()
+        return self.parts
+
+    async def close(self):
+        '''Returns the parts, rewound, the caller closes them.'''
+        return await asyncio.get_running_loop().run_in_executor(None, self._close)
+
+    def discard(self):
+        for part in self.parts:
+            part.close()
+        if not self._raw.closed:
+            self._raw.close()
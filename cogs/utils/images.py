@@ -1,35 +1,74 @@
+import math
 from PIL import Image, ImageSequence
 from io import BytesIO
 
+def _encode_png(im, **kwargs):
+    data = BytesIO()
+    im.save(data, 'png', **kwargs)
+    data.seek(0)
+    return data
+
+def _gif_encoder(im):
+    durations = []
+    frames = []
+    for frame in ImageSequence.Iterator(im):
+        durations.append(frame.info['duration'])
+        frames.append(frame.copy())
+    info = im.info
+    palette = im.getpalette()
+
+    def encode(size):
+        new_frames = [frame.resize(size, resample=Image.BICUBIC) for frame in frames]
+        data = BytesIO()
+        new_frames[0].save(
+            data,
+            save_all=True,
+            append_images=new_frames[1:],
+            format='gif',
+            version=info['version'],
+            duration=durations,
+            loop=0,
+            background=info['background'],
+            palette=palette)
+        data.seek(0)
+        return data
+    return encode
+
 def resize_to_limit(data, limit):
     '''
         Downsize it for huge PIL images.
-        Half the resolution until the byte count is within the limit.
+        PNGs first try an optimized encode and a 256 colour palette.
+        Otherwise the scale is estimated from the byte count, which is roughly proportional to the pixel count,
+        and corrected by up to two more trial encodes. Halving is the last resort.
     '''
     current_size = data.getbuffer().nbytes
-    while current_size > limit:
-        with Image.open(data) as im:
-            data = BytesIO()
-            if im.format == 'PNG':
-                im = im.resize([i//2 for i in im.size], resample=Image.BICUBIC)
-                im.save(data, 'png')
-            elif im.format == 'GIF':
-                durations = []
-                new_frames = []
-                for frame in ImageSequence.Iterator(im):
-                    durations.append(frame.info['duration'])
-                    new_frames.append(frame.resize([i//2 for i in im.size], resample=Image.BICUBIC))
-                new_frames[0].save(
-                    data,
-                    save_all=True,
-                    append_images=new_frames[1:],
-                    format='gif',
-                    version=im.info['version'],
-                    duration=durations,
-                    loop=0,
-                    background=im.info['background'],
-                    palette=im.getpalette())
-            data.seek(0)
+    if current_size <= limit:
+        return data
+    with Image.open(data) as im:
+        width, height = im.size
+        if im.format == 'GIF':
+            encode = _gif_encoder(im)
+        else:
+            im.load()
+            data = _encode_png(im, optimize=True)
+            if data.getbuffer().nbytes <= limit:
+                return data
+            if im.mode in ('RGB', 'RGBA'):
+                data = _encode_png(im.quantize(256, method=Image.FASTOCTREE), optimize=True)
+                if data.getbuffer().nbytes <= limit:
+                    return data
+            encode = lambda size: _encode_png(im.resize(size, resample=Image.BICUBIC))
+
+        scale = 1
+        for _ in range(3):
+            scale *= (limit / current_size) ** 0.5 * 0.95
+            data = encode((max(1, int(width * scale)), max(1, int(height * scale))))
+            current_size = data.getbuffer().nbytes
+            if current_size <= limit:
+                return data
+        while current_size > limit:
+            scale /= 2
+            data = encode((max(1, int(width * scale)), max(1, int(height * scale))))
             current_size = data.getbuffer().nbytes
     return data
 
@@ -39,4 +78,33 @@ def extract_first_frame(data):
         b = BytesIO()
         im.save(b, 'gif')
         b.seek(0)
-        return b
\ No newline at end of file
+        return b
+
+def thumbnail(avy, limit):
+    im = Image.open(avy).resize((200, 200), resample=Image.BICUBIC)
+    out = BytesIO()
+    im.save(out, 'png')
+    out.seek(0)
+    return resize_to_limit(out, limit)
+
+def quilt(avatars, limit):
+    xbound = math.ceil(math.sqrt(len(avatars)))
+    ybound = math.ceil(len(avatars) / xbound)
+    size = int(2520 / xbound)
+
+    with Image.new('RGBA', size=(xbound * size, ybound * size), color=(0,0,0,0)) as base:
+        x, y = 0, 0
+        for avy in avatars:
+            if avy:
+                im = Image.open(avy).resize((size,size), resample=Image.BICUBIC)
+                base.paste(im, box=(x * size, y * size))
+            if x < xbound - 1:
+                x += 1
+            else:
+                x = 0
+                y += 1
+        buffer = BytesIO()
+        base.save(buffer, 'png')
+        buffer.seek(0)
+        buffer = resize_to_limit(buffer, limit)
+        return buffer
\ No newline at end of file
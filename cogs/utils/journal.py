@@ -0,0 +1,118 @@
+import asyncio
+import os
+import pickle
+import struct
+
+_header = struct.Struct('<I')
+
+class Journal:
+    '''
+        Append-only on-disk log of queued records, split into numbered segment files.
+        Records are buffered in memory and written out by `sync`, which also fsyncs.
+        `rotate` seals the current segment; sealed segments are kept until `remove`d after they are in the db.
+        Segments left over from a previous run are sealed on startup so they get replayed.
+        Segments that cannot be written to the db are `bury`d in the dead subdirectory for someone to look at.
+    '''
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.sealed = self._segments()
+        self._seq = self.sealed[-1] + 1 if self.sealed else 0
+        self._buffer = bytearray()
+        self._file = None
+        self._retired = []
+        self._lock = asyncio.Lock()
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, f'{seq:010}.seg')
+
+    def _write(self):
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._file = open(self._segment_path(self._seq), 'ab', buffering=0)
+        self._file.write(self._buffer)
+        self._buffer = bytearray()
+
+    def append(self, record):
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self._buffer += _header.pack(len(data))
+        self._buffer += data
+
+    def __len__(self):
+        return len(self.sealed)
+
+    @property
+    def next_seq(self):
+        return self._seq
+
+    def start_at(self, seq):
+        '''Numbers the segments written from now on from seq, unless that would reuse a number.'''
+        if self._file is not None or self._buffer:
+            raise RuntimeError('the current segment has already been written to')
+        self._seq = max(self._seq, seq)
+
+    def rotate(self):
+        '''
+            Seals the current segment and starts a new one.
+            Returns the sequence number of the sealed segment.
+        '''
+        self._write()
+        seq = self._seq
+        if self._file is not None:
+            self._retired.append(self._file)
+            self._file = None
+            self.sealed.append(seq)
+        self._seq += 1
+        return seq
+
+    async def sync(self):
+        async with self._lock:
+            self._write()
+            files = self._retired[:]
+            if self._file is not None:
+                files.append(self._file)
+            if not files:
+                return
+            await asyncio.get_event_loop().run_in_executor(None, self._fsync, files)
+            for f in files:
+                if f is not self._file:
+                    self._retired.remove(f)
+                    f.close()
+
+    @staticmethod
+    def _fsync(files):
+        for f in files:
+            os.fsync(f.fileno())
+
+    def read(self, seq):
+        '''
+            Yields the records of a sealed segment.
+            A record cut off by a crash mid-write ends the segment.
+        '''
+        with open(self._segment_path(seq), 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _header.size <= len(data):
+            size, = _header.unpack_from(data, offset)
+            offset += _header.size
+            if offset + size > len(data):
+                break
+            yield pickle.loads(data[offset:offset + size])
+            offset += size
+
+    def remove(self, seq):
+        self.sealed.remove(seq)
+        os.remove(self._segment_path(seq))
+
+    def bury(self, seq):
+        '''Moves a sealed segment out of the journal into the dead subdirectory, returning its new path.'''
+        dead = os.path.join(self.path, 'dead')
+        os.makedirs(dead, exist_ok=True)
+        path = os.path.join(dead, os.path.basename(self._segment_path(seq)))
+        os.replace(self._segment_path(seq), path)
+        self.sealed.remove(seq)
+        return path
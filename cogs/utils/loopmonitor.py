@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os.path
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Stall:
+    __slots__ = ('beat', 'started', 'seconds', 'task', 'stack')
+
+    def __init__(self, beat, started, task, stack):
+        self.beat = beat
+        self.started = started
+        self.seconds = None
+        self.task = task
+        self.stack = stack
+
+
+def _describe(task):
+    if task is None:
+        return 'a callback'
+    coro = task.get_coro()
+    return f'{task.get_name()} ({getattr(coro, "__qualname__", coro)})'
+
+def _callback_stack(frame):
+    '''The stack of frame from the callback the loop is running, the loop's own frames are the same every time.'''
+    frames = traceback.extract_stack(frame)
+    for i in range(len(frames) - 1, -1, -1):
+        if frames[i].name == '_run' and frames[i].filename.endswith(os.path.join('asyncio', 'events.py')):
+            frames = frames[i + 1:]
+            break
+    return ''.join(traceback.format_list(frames))
+
+
+class LoopMonitor:
+    '''
+        Measures how late the event loop wakes a task that sleeps interval seconds, the delay every other callback sees too.
+        A watchdog thread notices when the loop has not woken it for threshold seconds past that,
+        and takes the stack of the loop's thread and the task it is running while it is still stuck.
+        The lag of the last samples is kept for percentiles, the last stalls with their stacks for the owner to look at.
+        Every report_interval seconds the percentiles are logged.
+    '''
+    def __init__(self, loop, metrics, interval, threshold, report_interval, samples=3000, stalls=20):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.samples = deque(maxlen=samples)
+        self.stalls = deque(maxlen=stalls)
+        self.lag_seconds = metrics.histogram('koishi_loop_lag_seconds', 'How late the event loop ran a timer.', LAG_BUCKETS)
+        self.stall_count = metrics.counter('koishi_loop_stalls_total', 'Times the event loop was blocked for longer than the threshold.')
+        self._beat = time.monotonic()
+        self._stall = None
+        self._thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        '''Starts monitoring, called from the loop's thread.'''
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = self.loop.create_task(self.tick())
+        self._watchdog = threading.Thread(target=self.watch, name='loop watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def tick(self):
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            previous, self._beat = self._beat, now
+            lag = max(0, now - expected)
+            self.samples.append(lag)
+            self.lag_seconds.observe(lag)
+
+            stall, self._stall = self._stall, None
+            if lag >= self.threshold:
+                self.stall_count.inc()
+                if stall is None or stall.beat != previous:
+                    # the watchdog did not look in time, there is no stack to show
+                    stall = Stall(previous, time.time() - lag, 'a callback', None)
+                stall.seconds = lag
+                self.stalls.append(stall)
+                logger.warning(f'event loop blocked for {lag*1000:.0f}ms by {stall.task}' + (f'\n{stall.stack}' if stall.stack else ''))
+
+            if now - last_report >= self.report_interval:
+                last_report = now
+                logger.info(f'event loop lag {self.format_percentiles()}, {len(self.stalls)} recent stalls')
+
+    def watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            if self._stall is not None:
+                continue
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            self._stall = Stall(beat, time.time() - blocked, _describe(asyncio.current_task(self.loop)), _callback_stack(frame))
+
+    def percentiles(self, *qs):
+        '''The lag at each quantile of the recent samples, in seconds.'''
+        ordered = sorted(self.samples)
+        if not ordered:
+            return [None for q in qs]
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs]
+
+    def format_percentiles(self):
+        p50, p95, p99, worst = self.percentiles(0.5, 0.95, 0.99, 1)
+        if p50 is None:
+            return 'not measured yet'
+        return f'p50 {p50*1000:.1f}ms, p95 {p95*1000:.1f}ms, p99 {p99*1000:.1f}ms, max {worst*1000:.1f}ms over {len(self.samples)} samples'
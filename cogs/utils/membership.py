@@ -0,0 +1,38 @@
+from bisect import bisect_left
+
+class MembershipIndex:
+    '''
+        Maps user ids to the sorted ids of the guilds the bot shares with them.
+        Adding and removing are idempotent so replayed events are harmless.
+    '''
+    def __init__(self):
+        self._guilds = {}
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def add(self, uid, gid):
+        guilds = self._guilds.setdefault(uid, [])
+        i = bisect_left(guilds, gid)
+        if i == len(guilds) or guilds[i] != gid:
+            guilds.insert(i, gid)
+        return len(guilds)
+
+    def remove(self, uid, gid):
+        '''Returns how many guilds are still shared with the user.'''
+        guilds = self._guilds.get(uid)
+        if guilds is None:
+            return 0
+        i = bisect_left(guilds, gid)
+        if i < len(guilds) and guilds[i] == gid:
+            del guilds[i]
+        if not guilds:
+            del self._guilds[uid]
+        return len(guilds)
+
+    def lowest(self, uid):
+        guilds = self._guilds.get(uid)
+        return guilds[0] if guilds else None
+
+    def clear(self):
+        self._guilds.clear()
@@ -0,0 +1,186 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, func=None, label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+        self._values = {}
+
+    def values(self):
+        '''Yields (labels, value) pairs, asking func if the metric is read from somewhere else.'''
+        if self.func is None:
+            yield from self._values.items()
+            return
+        value = self.func()
+        if self.label is None:
+            yield (), value
+        else:
+            for key, v in value.items():
+                yield ((self.label, key),), v
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in self.values():
+            lines.append(f'{self.name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+    def summary(self):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}' for labels, value in self.values()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[_labels(labels)] = value
+
+
+class _Buckets:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _labels(labels)
+        b = self._values.get(key)
+        if b is None:
+            b = self._values[key] = _Buckets(len(self.buckets) + 1)
+        b.counts[bisect_left(self.buckets, value)] += 1
+        b.sum += value
+        b.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q, **labels):
+        '''The upper bound of the bucket the q quantile falls in, or None if nothing was observed.'''
+        b = self._values.get(_labels(labels))
+        if b is None or not b.count:
+            return None
+        seen = 0
+        for bound, count in zip((*self.buckets, float('inf')), b.counts):
+            seen += count
+            if seen >= q * b.count:
+                return bound
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, b in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), b.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(labels, (("le", bound),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(b.sum)}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {b.count}')
+        return lines
+
+    def summary(self):
+        lines = []
+        for labels, b in self._values.items():
+            p50 = self.quantile(0.5, **dict(labels))
+            p95 = self.quantile(0.95, **dict(labels))
+            lines.append(
+                f'{self.name}{_format_labels(labels)} n={b.count} mean={b.sum / b.count * 1000:.1f}ms '
+                f'p50<={p50 * 1000:g}ms p95<={p95 * 1000:g}ms')
+        return lines
+
+
+class Registry:
+    '''
+        Counters, gauges and histograms by name. Asking for a metric that already exists returns it,
+        so cogs can declare theirs again when they are reloaded. Metrics given a func are read from it when exported,
+        a dict result is exposed with its keys as the values of label.
+    '''
+    def __init__(self):
+        self._metrics = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if not isinstance(metric, cls):
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif kwargs.get('func') is not None:
+            metric.func = kwargs['func']
+        return metric
+
+    def counter(self, name, help, func=None, label=None):
+        return self._get(Counter, name, help, func=func, label=label)
+
+    def gauge(self, name, help, func=None, label=None):
+        return self._get(Gauge, name, help, func=func, label=label)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def expose(self):
+        '''The Prometheus text format of every metric.'''
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, prefix=''):
+        lines = []
+        for name, metric in self._metrics.items():
+            if name.startswith(prefix):
+                lines.extend(metric.summary())
+        return lines
+
+    async def serve(self, host, port):
+        '''Serves the metrics on http://host:port/metrics, returns the runner to clean up.'''
+        async def metrics(request):
+            return web.Response(body=self.expose().encode(), headers={'Content-Type' : 'text/plain; version=0.0.4; charset=utf-8'})
+        app = web.Application()
+        app.router.add_get('/metrics', metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
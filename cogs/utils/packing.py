@@ -0,0 +1,17 @@
+def first_fit_decreasing(items, max_count, max_size):
+    '''
+        Packs (key, size) pairs into bins holding fewer than max_size in total and at most max_count items.
+        Items go largest first into the first bin they fit in.
+        Returns the bins as lists of keys, fullest first.
+    '''
+    bins = []
+    for key, size in sorted(items, key=lambda item: item[1], reverse=True):
+        for b in bins:
+            if len(b[0]) < max_count and b[1] + size < max_size:
+                b[0].append(key)
+                b[1] += size
+                break
+        else:
+            bins.append([[key], size])
+    bins.sort(key=lambda b: (len(b[0]), b[1]), reverse=True)
+    return [keys for keys, size in bins]
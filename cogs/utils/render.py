@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import charts
+
+logger = logging.getLogger(__name__)
+
+def _ready():
+    return True
+
+class RenderPool:
+    '''
+        Process pool for Pillow work, so renders are not serialized by the GIL.
+        Workers load the chart fonts and templates when they start, and `warm` starts them all up front.
+        If that fails, say the fonts are missing, the workers load them as charts need them instead
+        and only the charts fail, the avatar jobs need neither.
+        Workers are forked from a forkserver started with the first pool, not from the bot with all its threads.
+        A job is a module level function and its picklable arguments.
+        At most max_pending jobs are handed to the pool at once, the rest wait their turn.
+        A job that takes longer than timeout seconds raises asyncio.TimeoutError, though its worker finishes it regardless.
+    '''
+    def __init__(self, workers, max_pending, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_pending)
+        self._initializer = charts.warm
+        self._pool = self._create()
+
+    def _create(self):
+        context = multiprocessing.get_context('forkserver')
+        # the server imports these once so each worker does not have to
+        context.set_forkserver_preload(['cogs.utils.charts', 'cogs.utils.images'])
+        return ProcessPoolExecutor(self.workers, mp_context=context, initializer=self._initializer)
+
+    def _replace(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = self._create()
+
+    async def warm(self):
+        loop = asyncio.get_event_loop()
+        try:
+            await asyncio.gather(*[loop.run_in_executor(self._pool, _ready) for _ in range(self.workers)])
+        except BrokenProcessPool:
+            logger.exception('warming the render workers failed, they will load fonts and templates when needed')
+            self._initializer = None
+            self._replace()
+
+    async def render(self, func, *args):
+        loop = asyncio.get_event_loop()
+        async with self._slots:
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(self._pool, func, *args), self.timeout)
+            except BrokenProcessPool:
+                # a worker died, start over with a fresh pool for the next job
+                self._replace()
+                raise
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,343 @@
+import datetime
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+import numpy as np
+
+# same order as the status enum in schema.sql
+statuses = ('online', 'offline', 'invisible', 'dnd', 'idle', 'cog_offline', 'cog_online', 'left_guild')
+charted = ('offline', 'idle', 'online', 'dnd')
+
+_codes = {name : i for i, name in enumerate(statuses)}
+_charted = np.array([_codes[name] for name in charted])
+
+
+def _epoch(dt):
+    return np.datetime64(dt, 'us').astype(np.int64) / 1e6
+
+def _epochs(dts):
+    return np.array(dts, dtype='datetime64[us]').astype(np.int64) / 1e6
+
+def arrays(rows):
+    '''The times (epoch seconds) and status codes of (status, first_seen) rows.'''
+    return _epochs([row['first_seen'] for row in rows]), np.array([_codes[row['status']] for row in rows], dtype=np.int8)
+
+def _datetime(seconds):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=float(seconds))
+
+
+class Timeline:
+    '''
+        A user's status intervals between start and end, as arrays of start times, end times (epoch seconds) and status codes.
+        Built from the times (epoch seconds) and status codes of changes in any order. Of the changes before start only the latest
+        counts, clipped to start, and repeated statuses are merged into one interval.
+        The first interval does not start with a change of status since what came before it is unknown.
+    '''
+    def __init__(self, times, codes, start, end):
+        self.start = _epoch(start)
+        self.end = _epoch(end)
+        times = np.asarray(times, dtype=float)
+        codes = np.asarray(codes, dtype=np.int8)
+        order = np.argsort(times, kind='stable')
+        times, codes = times[order], codes[order]
+
+        keep = times < self.end
+        times, codes = times[keep], codes[keep]
+        first = max(np.searchsorted(times, self.start, side='right') - 1, 0)
+        times, codes = np.maximum(times[first:], self.start), codes[first:]
+
+        changed = np.ones(len(codes), dtype=bool)
+        changed[1:] = codes[1:] != codes[:-1]
+        self.starts = times[changed]
+        self.codes = codes[changed]
+        self.ends = np.append(self.starts[1:], self.end)
+
+    @classmethod
+    def from_rows(cls, rows, start, end):
+        '''Builds the timeline from (status, first_seen) rows.'''
+        return cls(*arrays(rows), start, end)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def durations(self):
+        return self.ends - self.starts
+
+    def totals(self):
+        '''Seconds spent in each status seen.'''
+        sums = np.bincount(self.codes, weights=self.durations, minlength=len(statuses))
+        seen = np.bincount(self.codes, minlength=len(statuses))
+        return {statuses[i] : float(sums[i]) for i in np.flatnonzero(seen)}
+
+    def hours(self):
+        '''The seconds spent in and changes to each status in each hour the timeline covers.'''
+        first = np.floor(self.start / 3600)
+        edges = np.arange(first, np.ceil(self.end / 3600) + 1) * 3600
+        seconds = np.zeros((len(edges) - 1, len(statuses)))
+        transitions = np.zeros((len(edges) - 1, len(statuses)), dtype=np.int64)
+        if not len(self):
+            return HourGrid(edges[0], seconds, transitions)
+        durations = self.durations
+        onehot = (self.codes[:, None] == np.arange(len(statuses))).astype(float)
+        # the time spent in each status up to each edge, which grows linearly inside an interval
+        cumulative = np.vstack((np.zeros(len(statuses)), np.cumsum(onehot * durations[:, None], axis=0)))
+        i = np.clip(np.searchsorted(self.starts, edges, side='right') - 1, 0, len(self) - 1)
+        inside = np.clip(edges - self.starts[i], 0, durations[i])
+        seconds = np.diff(cumulative[i] + onehot[i] * inside[:, None], axis=0)
+        changed = self.starts > self.start
+        np.add.at(transitions, ((self.starts[changed] // 3600 - first).astype(int), self.codes[changed]), 1)
+        return HourGrid(edges[0], seconds, transitions)
+
+
+class HourGrid:
+    '''
+        The seconds spent in and changes to each status in each hour, as (hours, statuses) arrays starting at the hour start (epoch seconds).
+        The rows it gives are shifted by tz hours.
+    '''
+    def __init__(self, start, seconds, transitions):
+        self.start = start
+        self.seconds = seconds
+        self.transitions = transitions
+
+    @classmethod
+    def from_rollup(cls, rows, latest, start, end, events=()):
+        '''
+            Builds the grid between start and end from status_hourly rows,
+            adding the open interval of latest, the user's last (status, first_seen) row, which is only rolled up once it ends.
+            events are the (status, first_seen) rows everyone shares, cog_log and uid 0 statuses, that cut into it.
+        '''
+        if latest:
+            events = [latest, *(e for e in events if e['first_seen'] > latest['first_seen'])]
+        grid = Timeline.from_rows(events, start, end).hours()
+        grid.transitions[:] = 0
+        if rows:
+            hours = ((_epochs([row['hour'] for row in rows]) - grid.start) // 3600).astype(int)
+            codes = np.array([_codes[row['status']] for row in rows])
+            keep = (hours >= 0) & (hours < len(grid.seconds))
+            np.add.at(grid.seconds, (hours[keep], codes[keep]), np.array([row['seconds'] for row in rows])[keep])
+            np.add.at(grid.transitions, (hours[keep], codes[keep]), np.array([row['transitions'] for row in rows])[keep])
+        return grid
+
+    def histogram(self, tz):
+        '''
+            Rows of (hour, status, percent) for the time spent in each charted status by hour of day,
+            relative to the largest of them.
+        '''
+        hours = (self.start // 3600 + tz + np.arange(len(self.seconds))).astype(int) % 24
+        totals = np.zeros((24, len(statuses)))
+        np.add.at(totals, hours, self.seconds)
+        totals = totals[:, _charted]
+        peak = totals.max()
+        return [
+            {'hour' : int(h), 'status' : charted[s], 'percent' : float(totals[h, s] / peak)}
+            for h, s in zip(*np.nonzero(totals))
+        ]
+
+    def _by_day(self, values, tz, days):
+        hours = (self.start // 3600 + tz + np.arange(len(values))).astype(np.int64)
+        rows = hours // 24 - hours[-1] // 24 + days - 1
+        keep = rows >= 0
+        grid = np.zeros((days, 24, *values.shape[1:]))
+        grid[rows[keep], hours[keep] % 24] = values[keep]
+        return grid
+
+    def day_shares(self, tz, days=31):
+        '''A (days, 24, charted statuses) array of the share of each hour spent in each charted status, the last day being today.'''
+        return self._by_day(self.seconds[:, _charted] / 3600, tz, days)
+
+    def day_changes(self, tz, days=31):
+        '''A (days, 24) array of the number of changes to a charted status in each hour, the last day being today.'''
+        return self._by_day(self.transitions[:, _charted].sum(axis=1), tz, days)
+
+
+def _shared(previous, changes, shared, cutoff):
+    '''
+        The shared (status, time) events falling between the earliest and the last change of each user, as (uid, status, time) rows.
+        Of the events before cutoff only the latest is kept, the rest end before the time that is rolled up.
+    '''
+    if not shared:
+        return []
+    shared = sorted(shared, key=lambda e: e[1])
+    bounds = {}
+    for uid, status, at in (*previous, *changes):
+        low, high = bounds.get(uid, (at, at))
+        bounds[uid] = (min(low, at), max(high, at))
+    uids = np.array(list(bounds), dtype=np.int64)
+    times = _epochs([at for status, at in shared])
+    firsts = np.searchsorted(times, _epochs([low for low, high in bounds.values()]), side='right')
+    firsts = np.maximum(firsts, np.searchsorted(times, _epoch(cutoff), side='right') - 1)
+    lasts = np.maximum(np.searchsorted(times, _epochs([high for low, high in bounds.values()]), side='left'), firsts)
+    counts = lasts - firsts
+    user = np.repeat(np.arange(len(uids)), counts)
+    event = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(firsts, counts)
+    return [(int(uids[u]), shared[e][0], shared[e][1]) for u, e in zip(user, event)]
+
+def rollup(previous, changes, cutoff, shared=()):
+    '''
+        Rolls status changes, rows of (uid, status, time), up into (uid, hour, status, seconds, transitions) rows for status_hourly.
+        previous holds the change before the first one of each user, already rolled up, whose interval is closed by it.
+        The last change of each user stays open and only its transition is counted. Time before cutoff is left out.
+        shared holds the (status, time) events everyone shares, cog_log and uid 0 statuses, which cut into the intervals
+        they fall in the same way they do in a Timeline, without counting as the user's transitions.
+    '''
+    events = sorted(
+        [(*row, False) for row in (*previous, *_shared(previous, changes, list(shared), cutoff))] + [(*row, True) for row in changes],
+        key=lambda e: (e[0], e[2]))
+    if not events:
+        return []
+    uids, names, times, changed = zip(*events)
+    uids = np.array(uids, dtype=np.int64)
+    codes = np.array([_codes[name] for name in names], dtype=np.int64)
+    times = _epochs(times)
+    changed = np.array(changed)
+    same = np.append(uids[1:] == uids[:-1], False)
+    starts = np.maximum(times, _epoch(cutoff))
+    ends = np.maximum(np.where(same, np.append(times[1:], 0), times), starts)
+
+    # split every interval into a piece per hour it spans
+    first = np.floor(starts / 3600).astype(np.int64)
+    counts = np.maximum(np.ceil(ends / 3600).astype(np.int64) - first, 1)
+    index = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    hours = (first[index] + offsets) * 3600
+    seconds = np.minimum(ends[index], hours + 3600) - np.maximum(starts[index], hours)
+    transitions = changed[index] & (offsets == 0)
+
+    keys, inverse = np.unique(np.stack((uids[index], hours, codes[index])), axis=1, return_inverse=True)
+    inverse = inverse.ravel()
+    seconds = np.bincount(inverse, weights=seconds)
+    transitions = np.bincount(inverse, weights=transitions)
+    return [
+        (int(uid), _datetime(hour), statuses[code], float(seconds[i]), int(transitions[i]))
+        for i, (uid, hour, code) in enumerate(keys.T)
+        if seconds[i] > 0 or transitions[i]
+    ]
+
+
+class _History:
+    __slots__ = ('times', 'codes', 'ready')
+
+    def __init__(self):
+        self.times = array('d')
+        self.codes = array('b')
+        self.ready = None
+
+
+class TimelineCache:
+    '''
+        The status changes of users who asked for their stats recently, so that asking again does not need the db.
+        Each user's changes are kept in time order as epoch seconds and status codes. Changes older than days are dropped
+        from the front, all but the latest of them which gives the status the window starts with.
+        Holds about max_bytes of changes, the least recently used users are evicted first.
+
+        A user is reserved before their changes are fetched so that changes appended meanwhile are kept,
+        `put` then merges in the fetched ones. `invalidate` drops users who became ready after since,
+        their fetch may have missed rows that were being written at the time.
+    '''
+    _change_bytes = 9
+    _user_bytes = 200
+
+    def __init__(self, max_bytes, days):
+        self.max_bytes = max_bytes
+        self.days = days
+        self.size = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, uid):
+        history = self._data.get(uid)
+        return history is not None and history.ready is not None
+
+    def _bytes(self, history):
+        return self._user_bytes + len(history.times) * self._change_bytes
+
+    def _trim(self, history):
+        # like a ring buffer the front is only cut once it is a good part of the whole, deleting from an array moves the rest
+        cutoff = time.time() - self.days * 86400
+        i = bisect_right(history.times, cutoff) - 1
+        if i > 0 and i * 4 >= len(history.times):
+            self.size -= i * self._change_bytes
+            del history.times[:i]
+            del history.codes[:i]
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._data) > 1:
+            uid, history = self._data.popitem(last=False)
+            self.size -= self._bytes(history)
+
+    def get(self, uid):
+        '''Returns the times and codes of the user's changes, or None if they are not cached.'''
+        history = self._data.get(uid)
+        if history is None or history.ready is None:
+            return None
+        self._data.move_to_end(uid)
+        self._trim(history)
+        return np.frombuffer(history.times, dtype=float).copy(), np.frombuffer(history.codes, dtype=np.int8).copy()
+
+    def reserve(self, uid):
+        if uid not in self._data:
+            self._data[uid] = history = _History()
+            self.size += self._bytes(history)
+
+    def put(self, uid, times, codes):
+        '''
+            Merges fetched changes into a reserved user and returns all of them like `get`.
+            If the user was invalidated or evicted since reserving, they are returned without being cached.
+        '''
+        times = np.asarray(times, dtype=float)
+        codes = np.asarray(codes, dtype=np.int8)
+        history = self._data.get(uid)
+        if history is None:
+            return times, codes
+        self.size -= self._bytes(history)
+        times = np.concatenate((times, np.frombuffer(history.times, dtype=float)))
+        codes = np.concatenate((codes, np.frombuffer(history.codes, dtype=np.int8)))
+        order = np.lexsort((codes, times))
+        times, codes = times[order], codes[order]
+        # changes appended while fetching can be in the fetched rows as well
+        unique = np.ones(len(times), dtype=bool)
+        unique[1:] = (times[1:] != times[:-1]) | (codes[1:] != codes[:-1])
+        times, codes = times[unique], codes[unique]
+        history.times = array('d', times.tobytes())
+        history.codes = array('b', codes.tobytes())
+        history.ready = time.monotonic()
+        self.size += self._bytes(history)
+        self._data.move_to_end(uid)
+        self._trim(history)
+        self._evict()
+        return times, codes
+
+    def append(self, uid, status, first_seen):
+        '''Adds a change of a cached or reserved user, anyone else is ignored.'''
+        history = self._data.get(uid)
+        if history is None:
+            return
+        history.times.append(_epoch(first_seen))
+        history.codes.append(_codes[status])
+        self.size += self._change_bytes
+        if len(history.times) % 1024 == 0:
+            self._trim(history)
+        self._evict()
+
+    def abandon(self, uid):
+        '''Drops a reserved user whose fetch failed.'''
+        history = self._data.get(uid)
+        if history is not None and history.ready is None:
+            del self._data[uid]
+            self.size -= self._bytes(history)
+
+    def invalidate(self, uids, since):
+        for uid in uids:
+            history = self._data.get(uid)
+            if history is not None and (history.ready is None or history.ready > since):
+                del self._data[uid]
+                self.size -= self._bytes(history)
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
@@ -0,0 +1,7 @@
+-- Creates applied_segments, where each flush records the journal segments it wrote.
+-- Run with the same search_path as schema.sql before starting the bot on an existing database.
+CREATE TABLE IF NOT EXISTS applied_segments(
+	recordtype TEXT NOT NULL,
+	seq BIGINT NOT NULL,
+	applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() at time zone 'utc'),
+	PRIMARY KEY (recordtype, seq));
@@ -0,0 +1,5 @@
+-- Creates compaction_checkpoints, where the compaction task keeps how far it has got through each history table.
+-- Run with the same search_path as schema.sql, the bot can keep running. Compaction starts over from ref 0.
+CREATE TABLE IF NOT EXISTS compaction_checkpoints(
+	recordtype TEXT PRIMARY KEY,
+	ref BIGINT NOT NULL);
@@ -0,0 +1,61 @@
+-- Moves an existing unpartitioned statuses table to the partitioned layout in schema.sql.
+-- Stop the bot first and run with the same search_path as schema.sql.
+BEGIN;
+
+ALTER TABLE statuses RENAME TO statuses_old;
+ALTER SEQUENCE statuses_ref_seq RENAME TO statuses_old_ref_seq;
+ALTER INDEX statuses_pkey RENAME TO statuses_old_pkey;
+ALTER INDEX statuses_uid_first_seen_idx RENAME TO statuses_old_uid_first_seen_idx;
+
+CREATE SEQUENCE statuses_ref_seq AS BIGINT;
+
+CREATE TABLE statuses(
+	ref BIGINT NOT NULL DEFAULT nextval('statuses_ref_seq'),
+	uid BIGINT NOT NULL,
+	status status NOT NULL,
+	first_seen TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	PRIMARY KEY (ref, first_seen))
+	PARTITION BY RANGE (first_seen);
+
+ALTER SEQUENCE statuses_ref_seq OWNED BY statuses.ref;
+
+CREATE TABLE statuses_default PARTITION OF statuses DEFAULT;
+
+CREATE INDEX "statuses_uid_first_seen_idx" ON statuses (uid, first_seen DESC NULLS LAST);
+
+CREATE TABLE statuses_archive(
+	ref BIGINT PRIMARY KEY,
+	uid BIGINT NOT NULL,
+	status status NOT NULL,
+	first_seen TIMESTAMP WITHOUT TIME ZONE NOT NULL);
+
+CREATE INDEX ON statuses_archive (uid, first_seen DESC);
+
+-- one partition per month from the oldest row up to next month
+DO $$
+DECLARE
+	month TIMESTAMP;
+BEGIN
+	FOR month IN
+		SELECT generate_series(
+			date_trunc('month', min(first_seen)),
+			date_trunc('month', now() at time zone 'utc') + interval '1 month',
+			interval '1 month')
+		FROM statuses_old
+	LOOP
+		EXECUTE format(
+			'CREATE TABLE %I PARTITION OF statuses FOR VALUES FROM (%L) TO (%L)',
+			'statuses_' || to_char(month, 'YYYY_MM'), month, month + interval '1 month');
+	END LOOP;
+END $$;
+
+INSERT INTO statuses (ref, uid, status, first_seen)
+SELECT ref, uid, status, first_seen
+FROM statuses_old
+WHERE first_seen IS NOT NULL;
+
+SELECT setval('statuses_ref_seq', max(ref)) FROM statuses_old;
+
+DROP TABLE statuses_old;
+
+COMMIT;
@@ -0,0 +1,39 @@
+-- Creates status_current and fills it in from the statuses already recorded.
+-- Stop the bot first and run with the same search_path as schema.sql.
+BEGIN;
+
+CREATE TABLE status_current(
+	uid BIGINT PRIMARY KEY,
+	status status NOT NULL,
+	since TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	last_offline TIMESTAMP WITHOUT TIME ZONE);
+
+-- cog_log and uid 0 statuses between a user's first and last status change it too, as they do in the bot
+WITH events AS (
+	SELECT status::text, first_seen FROM statuses WHERE uid = 0
+	UNION ALL
+	SELECT event::text, time FROM cog_log
+), history AS (
+	SELECT uid, status::text, first_seen FROM statuses WHERE uid != 0
+	UNION ALL
+	SELECT u.uid, e.status, e.first_seen
+	FROM (SELECT uid, min(first_seen) AS first_at, max(first_seen) AS last_at FROM statuses WHERE uid != 0 GROUP BY uid) u
+	JOIN events e ON e.first_seen > u.first_at AND e.first_seen < u.last_at
+), changes AS (
+	SELECT
+		uid,
+		status,
+		first_seen,
+		lag(status) OVER (PARTITION BY uid ORDER BY first_seen) AS status_lag
+	FROM history
+)
+INSERT INTO status_current (uid, status, since, last_offline)
+SELECT
+	uid,
+	(array_agg(status ORDER BY first_seen DESC))[1]::status,
+	max(first_seen) FILTER (WHERE status_lag IS DISTINCT FROM status),
+	max(first_seen) FILTER (WHERE status_lag = 'offline' AND status != 'offline')
+FROM changes
+GROUP BY uid;
+
+COMMIT;
@@ -0,0 +1,63 @@
+-- Creates status_hourly and fills it in from the statuses already recorded.
+-- Stop the bot first and run with the same search_path as schema.sql.
+BEGIN;
+
+CREATE TABLE status_hourly(
+	uid BIGINT NOT NULL,
+	hour TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	status status NOT NULL,
+	seconds DOUBLE PRECISION NOT NULL,
+	transitions INTEGER NOT NULL,
+	PRIMARY KEY (uid, hour, status));
+
+CREATE INDEX ON member_removes (uid, time DESC);
+
+-- the last change of each user stays open, the bot rolls it up once the next one is flushed
+-- cog_log and uid 0 statuses cut into the intervals of everyone seen before and after them, without counting as transitions
+WITH own AS (
+	SELECT uid, status, first_seen
+	FROM statuses
+	WHERE uid <> 0
+	UNION ALL
+	SELECT uid, 'left_guild', time
+	FROM member_removes
+), bounds AS (
+	SELECT uid, min(first_seen) AS low, max(first_seen) AS high
+	FROM own
+	GROUP BY uid
+), shared AS (
+	SELECT status, first_seen
+	FROM statuses
+	WHERE uid = 0
+	UNION ALL
+	SELECT event::text::status, time
+	FROM cog_log
+), changes AS (
+	SELECT
+		uid,
+		status,
+		first_seen,
+		changed,
+		lead(first_seen) OVER (PARTITION BY uid ORDER BY first_seen) AS last_seen
+	FROM (
+		SELECT uid, status, first_seen, true AS changed
+		FROM own
+		UNION ALL
+		SELECT b.uid, s.status, s.first_seen, false
+		FROM bounds b
+		JOIN shared s ON s.first_seen > b.low AND s.first_seen < b.high
+	) s
+)
+INSERT INTO status_hourly (uid, hour, status, seconds, transitions)
+SELECT
+	uid,
+	hour,
+	status,
+	sum(extract(epoch FROM least(coalesce(last_seen, first_seen), hour + interval '1 hour') - greatest(first_seen, hour))),
+	count(*) FILTER (WHERE changed AND hour = date_trunc('hour', first_seen))
+FROM changes,
+	generate_series(date_trunc('hour', first_seen), coalesce(last_seen, first_seen), interval '1 hour') AS hour
+WHERE hour < coalesce(last_seen, first_seen) OR hour = date_trunc('hour', first_seen)
+GROUP BY uid, hour, status;
+
+COMMIT;
@@ -43,14 +43,48 @@ CREATE INDEX ON nicks (uid, sid);
 
 CREATE TYPE status AS ENUM ('online', 'offline', 'invisible', 'dnd', 'idle', 'cog_offline', 'cog_online', 'left_guild');
 
+CREATE SEQUENCE koi_test.statuses_ref_seq AS BIGINT;
+
+-- partitioned by month, the bot creates upcoming partitions and drops ones past the retention period
 CREATE TABLE koi_test.statuses(
-	ref BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+	ref BIGINT NOT NULL DEFAULT nextval('statuses_ref_seq'),
 	uid BIGINT NOT NULL,
 	status status NOT NULL,
-	first_seen TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP);
+	first_seen TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	PRIMARY KEY (ref, first_seen))
+	PARTITION BY RANGE (first_seen);
+
+ALTER SEQUENCE statuses_ref_seq OWNED BY statuses.ref;
+
+-- catches rows outside of the monthly partitions
+CREATE TABLE koi_test.statuses_default PARTITION OF statuses DEFAULT;
 
 CREATE INDEX "statuses_uid_first_seen_idx" ON statuses (uid, first_seen DESC NULLS LAST);
-CLUSTER statuses USING statuses_uid_first_seen_idx;
+
+-- rows of users with keep set in presence_whitelist, moved here before their partition is dropped
+CREATE TABLE koi_test.statuses_archive(
+	ref BIGINT PRIMARY KEY,
+	uid BIGINT NOT NULL,
+	status status NOT NULL,
+	first_seen TIMESTAMP WITHOUT TIME ZONE NOT NULL);
+
+CREATE INDEX ON statuses_archive (uid, first_seen DESC);
+
+-- seconds spent in and changes to each status per user and hour, updated as statuses are flushed
+CREATE TABLE koi_test.status_hourly(
+	uid BIGINT NOT NULL,
+	hour TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	status status NOT NULL,
+	seconds DOUBLE PRECISION NOT NULL,
+	transitions INTEGER NOT NULL,
+	PRIMARY KEY (uid, hour, status));
+
+-- the status each user is in, when they changed to it and when they last stopped being offline
+CREATE TABLE koi_test.status_current(
+	uid BIGINT PRIMARY KEY,
+	status status NOT NULL,
+	since TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	last_offline TIMESTAMP WITHOUT TIME ZONE);
 
 CREATE TYPE koi_test.cog_event AS ENUM ('cog_offline', 'cog_online');
 
@@ -65,6 +99,20 @@ CREATE TABLE koi_test.member_removes(
 	uid BIGINT NOT NULL,
 	time TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP);
 
+CREATE INDEX ON member_removes (uid, time DESC);
+
+-- the highest ref the compaction task has deduplicated in each history table
+CREATE TABLE koi_test.compaction_checkpoints(
+	recordtype TEXT PRIMARY KEY,
+	ref BIGINT NOT NULL);
+
+-- the journal segments already written, so replaying one after a crash does not count it twice in status_hourly
+CREATE TABLE koi_test.applied_segments(
+	recordtype TEXT NOT NULL,
+	seq BIGINT NOT NULL,
+	applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() at time zone 'utc'),
+	PRIMARY KEY (recordtype, seq));
+
 CREATE TABLE koi_test.presence_whitelist(
 	uid BIGINT PRIMARY KEY,
 	keep BOOLEAN NOT NULL);
@@ -0,0 +1,28 @@
+import datetime
+
+from cogs.utils.columns import RecordBuffer
+
+columns = {'uid' : 'BIGINT', 'nick' : 'TEXT', 'status' : 'TEXT', 'first_seen' : 'TIMESTAMP WITHOUT TIME ZONE'}
+enums = {'status' : ('online', 'offline')}
+
+
+def test_records_come_back_as_they_went_in():
+    records = [
+        (1, 'ünïcødé \U0001f980', 'online', datetime.datetime(2026, 1, 1, 12, 30, 0, 1)),
+        (2, None, 'offline', None),
+        (3, '', 'online', datetime.datetime(1960, 1, 1)),
+        (4, '\ud800 lone surrogate', 'offline', datetime.datetime(2026, 1, 2)),
+        (5, None, 'online', datetime.datetime(2026, 1, 3)),
+    ]
+    buffer = RecordBuffer(columns, records, enums)
+    assert len(buffer) == len(records)
+    assert list(buffer) == records
+
+def test_a_bad_record_is_not_half_stored():
+    buffer = RecordBuffer(columns, [(1, 'a', 'online', None)], enums)
+    try:
+        buffer.append((2, 'b', 'invisible', None))
+    except KeyError:
+        pass
+    buffer.append((3, None, 'offline', None))
+    assert list(buffer) == [(1, 'a', 'online', None), (3, None, 'offline', None)]
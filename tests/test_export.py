@@ -0,0 +1,44 @@
+import asyncio
+import csv
+import gzip
+import io
+import random
+
+from cogs.utils.export import GzipParts
+
+
+def export(data, part_size, chunk_size):
+    async def run():
+        writer = GzipParts(b'id,text\n', part_size)
+        for i in range(0, len(data), chunk_size):
+            await writer.write(data[i:i + chunk_size])
+        parts = await writer.close()
+        try:
+            return [gzip.decompress(part.read()).decode() for part in parts]
+        finally:
+            writer.discard()
+    return asyncio.run(run())
+
+
+def test_parts_are_cut_between_rows(monkeypatch):
+    monkeypatch.setattr(GzipParts, 'SLACK', 0)
+    random.seed(0)
+    # quoted newlines and quotes in the values, which are not row ends
+    rows = [[str(i), ''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789"\n,') for _ in range(random.randint(0, 60)))] for i in range(20000)]
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerows(rows)
+
+    parts = export(out.getvalue().encode(), part_size=8000, chunk_size=777)
+    assert len(parts) > 1
+    read = []
+    for part in parts:
+        part_rows = list(csv.reader(io.StringIO(part)))
+        assert part_rows[0] == ['id', 'text']
+        read.extend(part_rows[1:])
+    assert read == rows
+
+def test_a_small_export_is_one_part():
+    assert export(b'1,a\n2,"b\nc"\n', part_size=8 * 1024 * 1024, chunk_size=3) == ['id,text\n1,a\n2,"b\nc"\n']
+
+def test_an_empty_export_is_the_header():
+    assert export(b'', part_size=8 * 1024 * 1024, chunk_size=1) == ['id,text\n']
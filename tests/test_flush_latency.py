@@ -0,0 +1,54 @@
+import asyncio
+import types
+
+import pytest
+
+pytest.importorskip('discord')
+pytest.importorskip('asyncpg')
+
+from cogs import pop
+
+
+def make_cog(loop, batch_size, max_latency):
+    bot = types.SimpleNamespace(
+        loop=loop,
+        flush_batch_size=batch_size,
+        flush_max_latency=max_latency,
+        pending_updates={'statuses' : []},
+        pending_removes=[])
+    cog = types.SimpleNamespace(bot=bot, pending_since=None, flush_wanted=asyncio.Event())
+    for name in ('pending_count', 'wait_for_flush', 'mark_pending'):
+        setattr(cog, name, types.MethodType(getattr(pop.Pop, name), cog))
+    return cog
+
+
+def test_one_record_is_flushed_within_the_latency_bound():
+    async def run():
+        loop = asyncio.get_running_loop()
+        cog = make_cog(loop, 10000, 0.2)
+        waiter = loop.create_task(cog.wait_for_flush())
+        # the queue is empty when the wait starts
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        queued = loop.time()
+        cog.bot.pending_updates['statuses'].append((1, 'online', None))
+        cog.mark_pending()
+        await asyncio.wait_for(waiter, 1)
+        return loop.time() - queued
+
+    waited = asyncio.run(run())
+    assert 0.15 <= waited < 0.5
+
+
+def test_a_full_batch_is_flushed_right_away():
+    async def run():
+        loop = asyncio.get_running_loop()
+        cog = make_cog(loop, 2, 10)
+        waiter = loop.create_task(cog.wait_for_flush())
+        for i in range(2):
+            await asyncio.sleep(0)
+            cog.bot.pending_updates['statuses'].append((i, 'online', None))
+            cog.mark_pending()
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(run())
@@ -0,0 +1,57 @@
+import asyncio
+import datetime
+import os
+
+from cogs.utils.journal import Journal
+
+
+def write(journal, records):
+    for record in records:
+        journal.append(record)
+    seq = journal.rotate()
+    asyncio.run(journal.sync())
+    return seq
+
+
+def test_records_read_back_in_order(tmp_path):
+    journal = Journal(str(tmp_path))
+    records = [(1, 'name', datetime.datetime(2026, 1, 1)), (2, None, datetime.datetime(2026, 1, 2))]
+    seq = write(journal, records)
+    assert journal.sealed == [seq]
+    assert list(journal.read(seq)) == records
+
+def test_rotating_an_empty_segment_seals_nothing(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.rotate()
+    assert journal.sealed == []
+
+def test_segments_left_by_a_crash_are_replayed(tmp_path):
+    journal = Journal(str(tmp_path))
+    first = write(journal, [(1,), (2,)])
+    second = write(journal, [(3,), (4,)])
+    journal.remove(first)
+    # cut the last record short, as a crash in the middle of writing it would
+    path = journal._segment_path(second)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+
+    reopened = Journal(str(tmp_path))
+    assert reopened.sealed == [second]
+    assert list(reopened.read(second)) == [(3,)]
+    assert reopened.next_seq == second + 1
+
+def test_start_at_does_not_reuse_numbers(tmp_path):
+    journal = Journal(str(tmp_path))
+    seq = write(journal, [(1,)])
+    journal.start_at(0)
+    assert journal.next_seq == seq + 1
+    journal.start_at(1000)
+    assert write(journal, [(2,)]) == 1000
+
+def test_buried_segments_leave_the_journal(tmp_path):
+    journal = Journal(str(tmp_path))
+    seq = write(journal, [(1,)])
+    path = journal.bury(seq)
+    assert journal.sealed == []
+    assert os.path.dirname(path) == os.path.join(str(tmp_path), 'dead')
+    assert Journal(str(tmp_path)).sealed == []
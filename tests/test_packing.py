@@ -0,0 +1,18 @@
+from cogs.utils.packing import first_fit_decreasing
+
+
+def test_bins_respect_both_limits():
+    items = [('a', 6), ('b', 5), ('c', 4), ('d', 3), ('e', 1), ('f', 1)]
+    bins = first_fit_decreasing(items, max_count=2, max_size=10)
+    sizes = dict(items)
+    assert sorted(key for b in bins for key in b) == sorted(sizes)
+    for b in bins:
+        assert len(b) <= 2
+        assert sum(sizes[key] for key in b) < 10
+
+def test_largest_go_first_and_fullest_bin_comes_first():
+    bins = first_fit_decreasing([('small', 1), ('big', 8), ('mid', 5)], max_count=10, max_size=10)
+    assert bins == [['big', 'small'], ['mid']]
+
+def test_an_item_too_big_for_any_bin_gets_its_own():
+    assert first_fit_decreasing([('huge', 20), ('tiny', 1)], max_count=10, max_size=10) == [['huge'], ['tiny']]
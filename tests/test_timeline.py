@@ -0,0 +1,125 @@
+import datetime
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from cogs.utils import timeline
+from cogs.utils.timeline import HourGrid, Timeline, TimelineCache, charted, statuses
+
+start = datetime.datetime(2026, 3, 1)
+end = start + datetime.timedelta(days=2)
+_charted = [statuses.index(name) for name in charted]
+
+
+def at(minutes):
+    return start + datetime.timedelta(minutes=minutes)
+
+# a restart, a member remove and a rejoin, with changes falling inside and across hours
+history = [
+    (1, 'online', at(5)),
+    (1, 'idle', at(50)),
+    (1, 'dnd', at(200)),
+    (1, 'online', at(431)),
+    (1, 'offline', at(600)),
+    (1, 'online', at(1201)),
+    (1, 'left_guild', at(1500)),
+    (1, 'online', at(1800)),
+    (1, 'idle', at(1830)),
+    (1, 'offline', at(2400)),
+]
+shared = [
+    ('cog_offline', at(300)),
+    ('cog_online', at(430)),
+    ('cog_offline', at(1900)),
+    ('cog_online', at(1950)),
+]
+
+
+def rows(*pairs):
+    return [{'status' : status, 'first_seen' : first_seen} for status, first_seen in pairs]
+
+def rolled_up(batches):
+    '''Rolls the batches of changes up one flush at a time, as update_hourly does, into status_hourly rows.'''
+    totals = {}
+    flushed = []
+    for batch in batches:
+        previous = flushed[-1:]
+        for uid, hour, status, seconds, transitions in timeline.rollup(previous, batch, start, shared):
+            row = totals.setdefault((hour, status), {'hour' : hour, 'status' : status, 'seconds' : 0, 'transitions' : 0})
+            row['seconds'] += seconds
+            row['transitions'] += transitions
+        flushed.extend(batch)
+    return list(totals.values())
+
+
+@pytest.mark.parametrize('cuts', [(), (1,), (3, 4), (2, 5, 6, 7, 9), tuple(range(1, 10))])
+def test_rollup_matches_timeline(cuts):
+    batches = [history[i:j] for i, j in zip((0, *cuts), (*cuts, len(history)))]
+    latest = {'status' : history[-1][1], 'first_seen' : history[-1][2]}
+    from_rollup = HourGrid.from_rollup(rolled_up(batches), latest, start, end, rows(*shared))
+    from_timeline = Timeline.from_rows(rows(*((status, first_seen) for uid, status, first_seen in history), *shared), start, end).hours()
+
+    assert from_rollup.start == from_timeline.start
+    np.testing.assert_allclose(from_rollup.seconds, from_timeline.seconds, atol=1e-6)
+    np.testing.assert_array_equal(from_rollup.transitions[:, _charted], from_timeline.transitions[:, _charted])
+
+def test_rollup_leaves_out_time_before_cutoff():
+    cutoff = at(90)
+    rolled = timeline.rollup([(1, 'online', at(0))], [(1, 'idle', at(120))], cutoff)
+    assert rolled == [
+        (1, at(60), 'online', 1800.0, 0),
+        (1, at(120), 'idle', 0.0, 1),
+    ]
+
+def test_rollup_keeps_the_latest_shared_event_before_cutoff():
+    cutoff = at(120)
+    events = [('cog_offline', at(30)), ('cog_online', at(60)), ('cog_offline', at(90))]
+    rolled = timeline.rollup([(1, 'online', at(0))], [(1, 'idle', at(150))], cutoff, events)
+    assert rolled == [
+        (1, at(120), 'idle', 0.0, 1),
+        (1, at(120), 'cog_offline', 1800.0, 0),
+    ]
+
+
+def test_timeline_clips_to_the_window_and_merges_repeats():
+    line = Timeline.from_rows(rows(('idle', at(-60)), ('online', at(-30)), ('online', at(10)), ('dnd', at(40))), start, at(60))
+    assert [statuses[code] for code in line.codes] == ['online', 'dnd']
+    assert line.totals() == {'online' : 2400.0, 'dnd' : 1200.0}
+
+def test_hours_count_changes_in_the_hour_they_start():
+    grid = Timeline.from_rows(rows(('online', at(0)), ('idle', at(90))), start, at(180)).hours()
+    idle = statuses.index('idle')
+    assert grid.seconds[:, statuses.index('online')].tolist() == [3600, 1800, 0]
+    assert grid.seconds[:, idle].tolist() == [0, 1800, 3600]
+    assert grid.transitions[:, idle].tolist() == [0, 1, 0]
+
+def test_histogram_is_relative_to_the_largest_hour():
+    grid = Timeline.from_rows(rows(('online', at(0)), ('idle', at(30))), start, at(60)).hours()
+    assert sorted((row['hour'], row['status'], row['percent']) for row in grid.histogram(tz=2)) == [(2, 'idle', 1.0), (2, 'online', 1.0)]
+
+
+def test_timeline_cache_merges_changes_appended_while_fetching():
+    cache = TimelineCache(10**6, days=30)
+    now = datetime.datetime.utcnow()
+    cache.reserve(1)
+    assert cache.get(1) is None
+    cache.append(1, 'idle', now)
+    times, codes = cache.put(1, timeline._epochs([now - datetime.timedelta(minutes=5), now]), [0, 4])
+    assert [statuses[code] for code in codes] == ['online', 'idle']
+    assert 1 in cache
+    assert cache.get(1)[0].tolist() == times.tolist()
+
+def test_timeline_cache_does_not_keep_users_invalidated_while_fetching():
+    cache = TimelineCache(10**6, days=30)
+    cache.reserve(1)
+    cache.invalidate([1], since=0)
+    cache.put(1, [1.0], [0])
+    assert 1 not in cache
+
+def test_timeline_cache_evicts_the_least_recently_used():
+    cache = TimelineCache(TimelineCache._user_bytes * 2 + TimelineCache._change_bytes * 2, days=30)
+    for uid in (1, 2, 3):
+        cache.reserve(uid)
+        cache.put(uid, [float(uid)], [0])
+    assert 1 not in cache and 2 in cache and 3 in cache